@@ -20,17 +20,64 @@ from hardware import generate
 from hardware import state
 
 import argparse
+import ast
 import glob
+import hashlib
+import json
 import netaddr
 import os
 import re
 import sys
+import tempfile
+import time
+
+from multiprocessing.pool import ThreadPool
 
 import requests
 import six
+from six.moves import cPickle
 import yaml
 
 _VERSION = "0.0.1"
+# NOTE: bump it when the content of Inputs changes
+_CACHE_VERSION = 2
+# NOTE: bump it when collect() output changes for the same inputs
+_MANIFEST_VERSION = 1
+_YAML_DUMPER = getattr(yaml, 'CDumper', yaml.Dumper)
+_YAML_LOADER = getattr(yaml, 'CLoader', yaml.Loader)
+# the config(...).write(...) calls of a .configure file
+_CONFIG_CALL_RE = re.compile(r'(config\([\s\S\n]*?)\)\n', re.MULTILINE)
+_CONFIG_WRITE_RE = re.compile(r"config\([\"'](.+?)[\"'].*write\(([\S\s]*''')",
+                              re.MULTILINE)
+# the checksums are fetched with this many connections
+_CHECKSUM_PARALLEL = 8
+# the connect and read timeouts of a checksum request, in seconds
+_CHECKSUM_TIMEOUT = (5, 30)
+# a cached checksum is revalidated after this delay, in seconds
+_CHECKSUM_MAX_AGE = 24 * 3600
+
+
+def _write_file(path, content):
+    """Replace a file atomically, the readers never get a partial file.
+
+    The file keeps its mode, a new file gets the default one of the umask.
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        try:
+            mode = os.stat(path).st_mode & 0o7777
+        except OSError:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        os.chmod(tmp_path, mode)
+        os.rename(tmp_path, path)
+    except (OSError, IOError):
+        os.unlink(tmp_path)
+        raise
 
 
 def _get_yaml_content(path):
@@ -42,11 +89,219 @@ def _get_yaml_content(path):
         sys.exit(1)
 
 
-def _get_router_configurations(config_path, global_conf):
-    cmdb_files = glob.glob("%s/edeploy/*.cmdb" % config_path)
-    cmdb_files = [os.path.splitext(os.path.basename(cmdb_file))[0]
-                  for cmdb_file in cmdb_files]
+class Inputs(object):
+    """The parsed content of a config-tools tree.
+
+    Each input file is read and parsed once and the stages of collect()
+    share the result. With a cache file, the parsed content is reused as
+    long as the size and the modification time of the files do not change.
+    The .configure files are only read with read_configure_files.
+
+    hardware has no public API to work on parsed files, the private
+    helpers of hardware.state are used instead, test_collector checks them
+    against State.hardware_info.
+    """
+
+    def __init__(self, config_path, cache_file=None,
+                 read_configure_files=True):
+        self.config_path = config_path
+        self.read_configure_files = read_configure_files
+        self.edeploy_dir = os.path.join(config_path, 'edeploy') + '/'
+        self.user_data_path = os.path.join(
+            config_path, "../var/www/cloud-init/user-data")
+        self.global_conf = None
+        self.state = []
+        self.cmdbs = {}
+        self.configure_files = {}
+        self.specs = {}
+        self.user_data = None
+        self._hosts = None
+        self._records = None
+
+        signature = self.signature()
+        if cache_file and self._load_cache(cache_file, signature):
+            return
+        self._parse()
+        if cache_file:
+            self._save_cache(cache_file, signature)
+
+    def paths(self):
+        paths = ["%s/config-tools/global.yml" % self.config_path,
+                 os.path.join(self.edeploy_dir, 'state')]
+        exts = ['cmdb', 'specs']
+        if self.read_configure_files:
+            exts.append('configure')
+        for ext in exts:
+            paths.extend(glob.glob("%s*.%s" % (self.edeploy_dir, ext)))
+        if os.path.exists(self.user_data_path):
+            paths.append(self.user_data_path)
+        return sorted(paths)
+
+    def hashes(self):
+        """Return the SHA-1 of each input file, by relative path."""
+        hashes = {}
+        for path in self.paths():
+            try:
+                with open(path, 'rb') as f:
+                    digest = hashlib.sha1(f.read()).hexdigest()
+            except IOError:
+                digest = None
+            hashes[os.path.relpath(path, self.config_path)] = digest
+        return hashes
+
+    def signature(self):
+        signature = {}
+        for path in self.paths():
+            try:
+                stat = os.stat(path)
+                signature[path] = (stat.st_size, stat.st_mtime)
+            except OSError:
+                signature[path] = None
+        return signature
+
+    def _parse(self):
+        self.global_conf = _get_yaml_content(
+            "%s/config-tools/global.yml" % self.config_path)
+        # expand keys prefixed by "="
+        self.global_conf["hosts"] = generate.generate_dict(
+            self.global_conf["hosts"], "=")
+
+        state_obj = state.State()
+        state_obj.load(self.edeploy_dir)
+        try:
+            self.state = list(state_obj._data)
+            for cmdb_file in sorted(glob.glob("%s*.cmdb" % self.edeploy_dir)):
+                name = os.path.splitext(os.path.basename(cmdb_file))[0]
+                self.cmdbs[name] = cmdb.load_cmdb(self.edeploy_dir,
+                                                  name) or []
+                if not self.read_configure_files:
+                    continue
+                try:
+                    with open("%s%s.configure" % (self.edeploy_dir,
+                                                  name)) as f:
+                        self.configure_files[name] = f.read()
+                except IOError:
+                    self.configure_files[name] = None
+            for name, _ in self.state:
+                self.specs[name] = state_obj._load_specs(name)
+        finally:
+            # release the lock obtained during the load call
+            state_obj.unlock()
+
+        if os.path.exists(self.user_data_path):
+            self.user_data = _get_yaml_content(self.user_data_path)
+
+    def _load_cache(self, cache_file, signature):
+        try:
+            with open(cache_file, 'rb') as f:
+                version, cached_signature, content = cPickle.load(f)
+        except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+            return False
+        if version != _CACHE_VERSION or cached_signature != signature or \
+           content['read_configure_files'] != self.read_configure_files:
+            return False
+        self.__dict__.update(content)
+        return True
+
+    def _save_cache(self, cache_file, signature):
+        content = dict((k, getattr(self, k))
+                       for k in ('global_conf', 'state', 'cmdbs',
+                                 'configure_files', 'specs', 'user_data',
+                                 'read_configure_files'))
+        try:
+            _write_file(cache_file, cPickle.dumps(
+                (_CACHE_VERSION, signature, content),
+                cPickle.HIGHEST_PROTOCOL))
+        except (OSError, IOError) as e:
+            print("Warning: cannot write the cache file '%s': %s" %
+                  (cache_file, e))
+
+    def _index(self):
+        self._hosts = {}
+        self._records = {}
+        # NOTE: the first CMDB of the state and the first entry win
+        for name, _ in reversed(self.state):
+            for rec in reversed(self.cmdbs.get(name, [])):
+                if 'hostname' in rec:
+                    self._hosts[rec['hostname']] = (name, rec)
+        for name, loaded_cmdb in sorted(six.iteritems(self.cmdbs)):
+            for rec in loaded_cmdb:
+                if 'hostname' in rec:
+                    self._records.setdefault(rec['hostname'], []).append(
+                        (name, rec))
+
+    def records(self, hostname):
+        """Return the CMDB name and entry of each record of a host."""
+        if self._records is None:
+            self._index()
+        return self._records.get(hostname, [])
+
+    def hardware_info(self, hostname):
+        """Same as hardware.state.State.hardware_info on the parsed files."""
+        if self._hosts is None:
+            self._index()
+        if hostname not in self._hosts:
+            return {}
+        name, info = self._hosts[hostname]
+        # NOTE: the matcher consumes the specs
+        specs = list(self.specs[name])
+        data = {}
+        mem = state.State._get_memory(specs)
+        if mem:
+            data['memory'] = mem
+        ncpus = state.State._get_ncpus(specs)
+        if ncpus:
+            data['ncpus'] = ncpus
+        disks = state.State._get_disks(specs)
+        if disks:
+            data['disks'] = disks
+        nics = state.State._get_nics(specs, info)
+        if nics:
+            data['nics'] = nics
+        return data
+
+
+class NetworkIndex(object):
+    """Find the most specific network of an IP address.
+
+    The networks are kept in a hash table per prefix length, so a lookup
+    costs one probe per distinct prefix length, whatever the number of
+    networks.
+    """
+
+    def __init__(self, networks=()):
+        self._tables = {}
+        # (version, prefixlen) from the most specific to the least one
+        self._prefixes = []
+        for netobj in networks:
+            self.add(netobj)
+
+    def add(self, netobj):
+        prefix = (netobj.version, netobj.prefixlen)
+        if prefix not in self._tables:
+            self._tables[prefix] = (int(netobj.netmask), {})
+            self._prefixes = sorted(self._tables, key=lambda p: -p[1])
+        netmask, table = self._tables[prefix]
+        table.setdefault(int(netobj.ip) & netmask, netobj)
+
+    def lookup(self, ip):
+        """Return the longest prefix network containing ip, or None."""
+        ip = netaddr.IPAddress(ip)
+        for version, prefixlen in self._prefixes:
+            if version != ip.version:
+                continue
+            netmask, table = self._tables[(version, prefixlen)]
+            netobj = table.get(int(ip) & netmask)
+            if netobj is not None:
+                return netobj
+        return None
 
+    def __len__(self):
+        return sum(len(table) for _, table in self._tables.values())
+
+
+def _get_router_configurations(inputs):
+    global_conf = inputs.global_conf
     detected_net = {}
     for k, v in six.iteritems(global_conf['config']):
         m = re.search('(\w+)_(ip|netif|network|gateway)', k)
@@ -69,8 +324,7 @@ def _get_router_configurations(config_path, global_conf):
         else:
             print("type not supported: %s" % val_type)
 
-    for cmdb_file in cmdb_files:
-        loaded_cmdb = cmdb.load_cmdb("%s/edeploy/" % config_path, cmdb_file)
+    for _, loaded_cmdb in sorted(six.iteritems(inputs.cmdbs)):
         for host in loaded_cmdb:
             for k, v in six.iteritems(host):
                 m = re.search('(vlan|gateway|netmask|network)(-(\w+|)|)', k)
@@ -89,17 +343,15 @@ def _get_router_configurations(config_path, global_conf):
                 else:
                     detected_net[net_name][val_type] = v
 
+    networks = NetworkIndex(net['netobj'] for net in detected_net.values()
+                            if 'netobj' in net)
     for host in global_conf['hosts']:
         ip = global_conf['hosts'][host]['ip']
-        found = False
-        for net in detected_net.values():
-            if 'netobj' in net and ip in net['netobj']:
-                found = True
-                continue
-        if not found:
+        if networks.lookup(ip) is None:
             detected_net[host + '-net'] = {
                 'netobj': netaddr.IPNetwork(ip + '/24')
             }
+            networks.add(detected_net[host + '-net']['netobj'])
     nics = {}
     for net in detected_net.values():
         if 'netobj' not in net:
@@ -121,76 +373,195 @@ def _get_router_configurations(config_path, global_conf):
         if 'ip' not in entry:
             print("Cannot find the gateway for network %s." % netobj)
 
-    return nics
+    return nics, networks
 
 
-def _get_files(config_path):
-    cmdb_files = glob.glob("%s/edeploy/*.cmdb" % config_path)
-    cmdb_files = [os.path.splitext(os.path.basename(cmdb_file))[0]
-                  for cmdb_file in cmdb_files]
+def _parse_configure_file(content):
+    """Return the path and the template of each file of a .configure file.
 
-    files = {}
-    for cmdb_file in cmdb_files:
-        loaded_cmdb = cmdb.load_cmdb("%s/edeploy/" % config_path, cmdb_file)
-        configure_file = "%s/edeploy/%s.configure" % (config_path, cmdb_file)
-        configure_file_content = ""
+    A template is the string literal given to write(), it is rendered with
+    the % operator and the CMDB entry of a host.
+    """
+    templates = []
+    for line in _CONFIG_CALL_RE.findall(content):
+        m = _CONFIG_WRITE_RE.match(line)
+        if not m:
+            continue
+        file_path = m.group(1)
+        # For the moment, we keep our fstab
+        if file_path.startswith("/etc/fstab"):
+            continue
         try:
-            configure_file_content = open(configure_file, 'r').read()
-        except IOError:
-            return {}
+            template = ast.literal_eval(m.group(2))
+        except (ValueError, SyntaxError) as e:
+            print("Cannot parse the template of '%s': %s" % (file_path, e))
+            continue
+        templates.append((file_path, template))
+    return templates
 
+
+def _get_files(inputs, hostnames=None):
+    files = {}
+    for cmdb_file, loaded_cmdb in sorted(six.iteritems(inputs.cmdbs)):
+        configure_file_content = inputs.configure_files.get(cmdb_file)
+        # NOTE: the hosts of this CMDB use the standard configuration
+        if configure_file_content is None:
+            continue
+        if hostnames is not None:
+            loaded_cmdb = [host for host in loaded_cmdb
+                           if host['hostname'] in hostnames]
+            if not loaded_cmdb:
+                continue
+        templates = _parse_configure_file(configure_file_content)
         for host in loaded_cmdb:
-            files[host['hostname']] = []
-            for line in re.findall(r'(config\([\s\S\n]*?)\)\n',
-                                   configure_file_content, re.MULTILINE):
-                m = re.match(r"config\([\"'](.+?)[\"'].*write\(([\S\s]*''')",
-                             line, re.MULTILINE)
-                file_path = m.group(1)
-                # For the moment, we keep our fstab
-                if file_path.startswith("/etc/fstab"):
-                    continue
-                files[host['hostname']].append({
-                    'path': file_path,
-                    'content': eval("%s %% %s" % (m.group(2), str(host)))
-                })
+            files[host['hostname']] = [{'path': file_path,
+                                        'content': template % host}
+                                       for file_path, template in templates]
     return files
 
 
-def _get_checksum(images_url, sps_version, img):
-
+def _fetch_checksum(session, url, entry):
+    """Return the cache entry of a checksum url, revalidating entry."""
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    resp = session.get(url, headers=headers, timeout=_CHECKSUM_TIMEOUT)
+    if resp.status_code == 304 and entry.get('checksum'):
+        return dict(entry, fetched=time.time())
+    resp.raise_for_status()
+    return {'checksum': resp.text.split(" ")[0],
+            'etag': resp.headers.get('ETag'),
+            'last_modified': resp.headers.get('Last-Modified'),
+            'fetched': time.time()}
+
+
+def _get_checksums(images_url, sps_version, images, cache_file=None,
+                   max_age=_CHECKSUM_MAX_AGE):
+    """Return the checksum of each image, None when it is unknown.
+
+    The checksums are fetched concurrently. With a cache file, a checksum
+    is reused without any request until it is older than max_age seconds,
+    then it is revalidated with its ETag and Last-Modified headers.
+    """
+    checksums = dict((img, None) for img in images)
     if not images_url:
-        return None
+        return checksums
 
-    try:
-        img_checksum = img.replace("qcow2", "md5")
-        url = "%s/%s/%s" % (images_url, sps_version, img_checksum)
-        resp = requests.get(url)
-    except requests.exceptions.MissingSchema as e:
-        print("Invalid url '%s': %s" % (url, e))
+    cache = {}
+    if cache_file and os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'r') as f:
+                cache = json.load(f)
+        except (IOError, ValueError) as e:
+            print("Warning: ignoring the checksums cache '%s': %s" %
+                  (cache_file, e))
+    urls = dict((img, "%s/%s/%s" % (images_url, sps_version,
+                                    img.replace("qcow2", "md5")))
+                for img in checksums)
+    now = time.time()
+    to_fetch = sorted(img for img, url in six.iteritems(urls)
+                      if now - cache.get(url, {}).get('fetched', 0) > max_age)
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=_CHECKSUM_PARALLEL)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    def fetch(img):
+        url = urls[img]
+        try:
+            return img, _fetch_checksum(session, url, cache.get(url, {})), None
+        except requests.exceptions.MissingSchema as e:
+            print("Invalid url '%s': %s" % (url, e))
+            return img, None, True
+        except requests.exceptions.RequestException as e:
+            print("Unreachable url '%s': %s" % (url, e))
+            return img, None, False
+
+    results = []
+    if to_fetch:
+        pool = ThreadPool(min(_CHECKSUM_PARALLEL, len(to_fetch)))
+        try:
+            results = pool.map(fetch, to_fetch)
+        finally:
+            pool.close()
+            pool.join()
+            session.close()
+    if [fatal for _, _, fatal in results if fatal]:
         sys.exit(1)
-    except requests.exceptions.ConnectionError as e:
-        print("Unreachable url '%s': %s" % (url, e))
-        print("The infra description will not contain the images checksums.")
-        return None
-
-    return resp.text.split(" ")[0].encode("utf8")
-
-
-def collect(config_path, qcow, sps_version, images_url, parse_configure_files):
+    for img, entry, _ in results:
+        if entry:
+            cache[urls[img]] = entry
+    if None in [entry for _, entry, _ in results]:
+        print("The infra description will not contain the images checksums "
+              "that cannot be fetched.")
+
+    for img, url in six.iteritems(urls):
+        # NOTE: a stale checksum is still used when the url is unreachable
+        if cache.get(url, {}).get('checksum'):
+            checksums[img] = cache[url]['checksum'].encode("utf8")
+    if cache_file and results:
+        try:
+            _write_file(cache_file, json.dumps(
+                cache, indent=2, sort_keys=True).encode('utf-8'))
+        except (OSError, IOError) as e:
+            print("Warning: cannot write the checksums cache '%s': %s" %
+                  (cache_file, e))
+    return checksums
+
+
+def _host_digest(inputs, hostname, *values):
+    """Return a digest of everything the configuration of a host uses."""
+    global_conf = inputs.global_conf
+    host = global_conf["hosts"][hostname]
+    records = [(name, rec, inputs.specs.get(name),
+                inputs.configure_files.get(name))
+               for name, rec in inputs.records(hostname)]
+    content = json.dumps([
+        host,
+        global_conf["profiles"].get(host.get("profile")),
+        global_conf.get("config"),
+        global_conf.get("infra_virt", {}).get(hostname),
+        records,
+        inputs.user_data,
+        values], sort_keys=True, default=str)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def collect(config_path, qcow, sps_version, images_url, parse_configure_files,
+            cache_file=None, checksums_cache=None,
+            checksums_max_age=_CHECKSUM_MAX_AGE):
+    return _collect(config_path, qcow, sps_version, images_url,
+                    parse_configure_files, cache_file, checksums_cache,
+                    checksums_max_age)[0]
+
+
+def _collect(config_path, qcow, sps_version, images_url,
+             parse_configure_files, cache_file=None, checksums_cache=None,
+             checksums_max_age=_CHECKSUM_MAX_AGE, previous=None):
+    """Return the virtual platform and the manifest of its inputs.
+
+    previous is the virtual platform and the manifest of a former run, the
+    hosts whose inputs did not change since then are reused as they are.
+    """
     # check config directory path
     if not os.path.exists(config_path):
         print("Error: --config-dir='%s' does not exist." % config_path)
         sys.exit(1)
 
-    images_checksums = {}
-    # get state object
-    state_obj = state.State()
-    state_obj.load(os.path.join(config_path, 'edeploy') + '/')
+    inputs = Inputs(config_path, cache_file, bool(parse_configure_files))
+    global_conf = inputs.global_conf
 
-    # get global conf
-    global_conf = _get_yaml_content("%s/config-tools/global.yml" % config_path)
-    # expand keys prefixed by "="
-    global_conf["hosts"] = generate.generate_dict(global_conf["hosts"], "=")
+    # NOTE: all the checksums are fetched at once, before the hosts loop
+    images = ["%s-%s.img.qcow2" % ("install-server", sps_version)]
+    for host in six.itervalues(global_conf["hosts"]):
+        edeploy_role = global_conf["profiles"][host["profile"]]["edeploy"]
+        images.append("%s-%s.img.qcow2" % (edeploy_role, sps_version))
+    images_checksums = _get_checksums(images_url, sps_version, images,
+                                      checksums_cache, checksums_max_age)
 
     # the virtual configuration of each host
     virt_platform = {"hosts": {}}
@@ -203,13 +574,32 @@ def collect(config_path, qcow, sps_version, images_url, parse_configure_files):
     virt_platform["hosts"]["router"]["profile"] = 'router'
 
     # adds image checksum to the router
-    checksum = _get_checksum(images_url, sps_version, img_name)
-    images_checksums[img_name] = checksum
+    checksum = images_checksums[img_name]
     if checksum:
         virt_platform["hosts"]["router"]["disks"][0]['checksum'] = checksum
 
-    router_configurations = _get_router_configurations(config_path,
-                                                       global_conf)
+    router_configurations, networks = _get_router_configurations(inputs)
+    networks_content = sorted((str(netobj), entry) for netobj, entry
+                              in six.iteritems(router_configurations))
+
+    # the hosts whose inputs did not change are taken from the previous run
+    digests = {}
+    for hostname, host in six.iteritems(global_conf["hosts"]):
+        edeploy_role = global_conf["profiles"][host["profile"]]["edeploy"]
+        img_name = "%s-%s.img.qcow2" % (edeploy_role, sps_version)
+        digests[hostname] = _host_digest(
+            inputs, hostname, qcow, sps_version, images_url,
+            parse_configure_files, images_checksums.get(img_name),
+            networks_content)
+    previous_platform, previous_manifest = previous or ({"hosts": {}}, {})
+    reused = dict(
+        (hostname, previous_platform["hosts"][hostname])
+        for hostname, digest in six.iteritems(digests)
+        if previous_manifest.get("hosts", {}).get(hostname) == digest and
+        hostname in previous_platform["hosts"])
+    hostnames = [hostname for hostname in global_conf["hosts"]
+                 if hostname not in reused]
+
     router_nics = [n for n in router_configurations.values() if 'ip' in n]
     virt_platform["hosts"]["router"]["nics"] = router_nics
     virt_platform["hosts"]["router"]["nics"].append({
@@ -218,17 +608,13 @@ def collect(config_path, qcow, sps_version, images_url, parse_configure_files):
         "network_name": "__public_network__"})
 
     # adds hardware info to the hosts
-    for hostname in global_conf["hosts"]:
+    for hostname in hostnames:
         # construct the host virtual configuration
-        virt_platform["hosts"][hostname] = state_obj.hardware_info(hostname)
+        virt_platform["hosts"][hostname] = inputs.hardware_info(hostname)
         profile = global_conf["hosts"][hostname]["profile"]
         edeploy_role = global_conf["profiles"][profile]["edeploy"]
         img_name = "%s-%s.img.qcow2" % (edeploy_role, sps_version)
 
-        if img_name not in images_checksums:
-            checksum = _get_checksum(images_url, sps_version, img_name)
-            images_checksums[img_name] = checksum
-
         if qcow or \
            global_conf["hosts"][hostname]["profile"] == "install-server":
             if 'disks' not in virt_platform["hosts"][hostname]:
@@ -242,12 +628,10 @@ def collect(config_path, qcow, sps_version, images_url, parse_configure_files):
         virt_platform["hosts"][hostname]["profile"] = \
             global_conf["hosts"][hostname]["profile"]
 
-    # release the lock obtained during the load call
-    state_obj.unlock()
-
-    configure_files = _get_files(config_path)
+    configure_files = _get_files(inputs, set(hostnames)) \
+        if parse_configure_files else {}
     # adds network info to the hosts
-    for hostname in global_conf["hosts"]:
+    for hostname in hostnames:
         admin_network = global_conf["config"]["admin_network"]
         admin_network = netaddr.IPNetwork(admin_network)
         try:
@@ -256,6 +640,8 @@ def collect(config_path, qcow, sps_version, images_url, parse_configure_files):
             nics = [{}]
 
         network_configuration = "file" if parse_configure_files else "standard"
+        ip = global_conf["hosts"][hostname]["ip"]
+        entry = router_configurations.get(networks.lookup(ip))
 
         if network_configuration == "file":
             try:
@@ -267,18 +653,14 @@ def collect(config_path, qcow, sps_version, images_url, parse_configure_files):
                       % hostname)
                 network_configuration = "standard"
 
-        if network_configuration == "standard":
-            ip = global_conf["hosts"][hostname]["ip"]
-            for netobj, entry in six.iteritems(router_configurations):
-                if ip in netobj:
-                    first_nic = {
-                        'network': entry['network'],
-                        'netmask': entry['netmask'],
-                        'gateway': entry['ip'],
-                        'ip': ip,
-                    }
-                    nics[0].update(first_nic)
-                    break
+        if network_configuration == "standard" and entry:
+            first_nic = {
+                'network': entry['network'],
+                'netmask': entry['netmask'],
+                'gateway': entry['ip'],
+                'ip': ip,
+            }
+            nics[0].update(first_nic)
         if global_conf["hosts"][hostname]["profile"] == "install-server":
             nics.append({
                 "bootproto": "dhcp",
@@ -296,25 +678,61 @@ def collect(config_path, qcow, sps_version, images_url, parse_configure_files):
                 pass
 
     # Inject the cloud-init write_files section
-    user_data_path = config_path + "/../var/www/cloud-init/user-data"
-    if os.path.exists(user_data_path):
-        user_data_fd = open(user_data_path, 'r')
-        user_data = yaml.load(user_data_fd.read())
-        for hostname in global_conf["hosts"]:
-            virt_platform['hosts'][hostname]['write_files'] = user_data[
-                'write_files']
+    if inputs.user_data is not None:
+        for hostname in hostnames:
+            virt_platform['hosts'][hostname]['write_files'] = \
+                inputs.user_data['write_files']
+
+    virt_platform["hosts"].update(reused)
+    if previous:
+        print("%d hosts regenerated, %d hosts unchanged." %
+              (len(hostnames), len(reused)))
 
     if images_url:
         virt_platform["images-url"] = "%s/%s" % (images_url, sps_version)
-    return virt_platform
+    manifest = json.loads(json.dumps({
+        "version": _MANIFEST_VERSION,
+        "inputs": inputs.hashes(),
+        "checksums": images_checksums,
+        "hosts": digests}, default=str))
+    return virt_platform, manifest
+
 
+def _output_paths(output_path):
+    return (os.path.normpath("%s/virt_platform.yml" % output_path),
+            os.path.normpath("%s/virt_platform.manifest" % output_path))
 
-def save_virt_platform(virt_platform, output_path):
-    output_file_path = os.path.normpath("%s/virt_platform.yml" % output_path)
+
+def load_previous(output_path):
+    """Return the virtual platform and the manifest of the last run.
+
+    None is returned when there is no usable previous run.
+    """
+    output_file_path, manifest_path = _output_paths(output_path)
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        with open(output_file_path, 'r') as f:
+            virt_platform = yaml.load(f, Loader=_YAML_LOADER)
+    except (IOError, ValueError, yaml.YAMLError):
+        return None
+    if manifest.get("version") != _MANIFEST_VERSION or \
+       not isinstance(virt_platform, dict) or "hosts" not in virt_platform:
+        return None
+    return virt_platform, manifest
+
+
+def save_virt_platform(virt_platform, output_path, manifest=None):
+    output_file_path, manifest_path = _output_paths(output_path)
 
     try:
-        with open(output_file_path, 'w') as outfile:
-            outfile.write(yaml.dump(virt_platform, default_flow_style=False))
+        # NOTE: the manifest is written last, a partial run is not trusted
+        _write_file(output_file_path, yaml.dump(
+            virt_platform, default_flow_style=False, encoding='utf-8',
+            Dumper=_YAML_DUMPER))
+        if manifest is not None:
+            _write_file(manifest_path, json.dumps(
+                manifest, indent=2, sort_keys=True).encode('utf-8'))
         print("Virtual platform generated successfully at '%s' !" %
               output_file_path)
     except (OSError, IOError) as e:
@@ -350,16 +768,49 @@ def main():
     cli_parser.add_argument('--images-url',
                             required=False,
                             help='Url of the qcow images.')
+    cli_parser.add_argument('--cache-file',
+                            required=False,
+                            help='Keep the parsed input files in this file '
+                                 'to reuse them while they do not change.')
+    cli_parser.add_argument('--checksums-cache',
+                            required=False,
+                            help='Keep the images checksums in this file.')
+    cli_parser.add_argument('--checksums-max-age',
+                            required=False,
+                            default=_CHECKSUM_MAX_AGE,
+                            type=int,
+                            help='Revalidate the cached checksums older '
+                                 'than this number of seconds.')
+    cli_parser.add_argument('--full',
+                            required=False,
+                            default=False,
+                            action="store_true",
+                            help='Regenerate all the hosts, even the ones '
+                                 'whose inputs did not change since the '
+                                 'last run.')
 
     cli_arguments = cli_parser.parse_args()
 
-    virt_platform = collect(cli_arguments.config_dir, cli_arguments.qcow,
-                            cli_arguments.sps_version,
-                            cli_arguments.images_url,
-                            cli_arguments.parse_configure_files)
-
+    previous = None
+    if not cli_arguments.full:
+        previous = load_previous(cli_arguments.output_dir)
+    virt_platform, manifest = _collect(cli_arguments.config_dir,
+                                       cli_arguments.qcow,
+                                       cli_arguments.sps_version,
+                                       cli_arguments.images_url,
+                                       cli_arguments.parse_configure_files,
+                                       cli_arguments.cache_file,
+                                       cli_arguments.checksums_cache,
+                                       cli_arguments.checksums_max_age,
+                                       previous)
+
+    if previous and previous[1] == manifest:
+        print("Virtual platform at '%s' is up to date." %
+              _output_paths(cli_arguments.output_dir)[0])
+        return
     save_virt_platform(virt_platform,
-                       cli_arguments.output_dir)
+                       cli_arguments.output_dir,
+                       manifest)
 
 
 if __name__ == '__main__':
@@ -21,11 +21,35 @@ HOST = """
   <uuid>{{ uuid }}</uuid>
   <memory unit='KiB'>{{ memory }}</memory>
   <currentmemory unit='KiB'>{{ memory }}</currentmemory>
-  <vcpu>{{ ncpus }}</vcpu>
+  <vcpu placement='static'>{{ ncpus }}</vcpu>
+{% if performance.vcpu_pinning is defined %}
+  <cputune>
+{% for cpuset in performance.vcpu_pinning %}
+    <vcpupin vcpu='{{ loop.index0 }}' cpuset='{{ cpuset }}'/>
+{% endfor %}
+  </cputune>
+{% endif %}
+{% if performance.iothreads is defined %}
+  <iothreads>{{ performance.iothreads }}</iothreads>
+{% endif %}
+{% if performance.numa_node is defined %}
+  <numatune>
+    <memory mode='strict' nodeset='{{ performance.numa_node }}'/>
+  </numatune>
+{% endif %}
+{% if performance.hugepages|default(false) %}
+  <memoryBacking>
+    <hugepages/>
+  </memoryBacking>
+{% endif %}
+{% if performance.cpu_mode is defined %}
+  <cpu mode='{{ performance.cpu_mode }}'/>
+{% else %}
   <cpu match='exact'>
     <model>Westmere</model>
     <feature policy='require' name='vmx'/>
   </cpu>
+{% endif %}
   <os>
     <smbios mode='sysinfo'/>
     <type arch='x86_64' machine='pc'>hvm</type>
@@ -37,6 +61,7 @@ HOST = """
       <virtualizor:profile>{{ profile }}</virtualizor:profile>
       <virtualizor:prefix>{{ prefix }}</virtualizor:prefix>
       <virtualizor:hostname>{{ hostname }}</virtualizor:hostname>
+      <virtualizor:fingerprint>{{ fingerprint }}</virtualizor:fingerprint>
     </virtualizor:instance>
   </metadata>
   <sysinfo type='smbios'>
@@ -62,7 +87,14 @@ HOST = """
     <emulator>{{ emulator }}</emulator>
 {% for disk in disks %}
     <disk type='file' device='disk'>
-      <driver name='qemu' type='qcow2'/>
+      <driver name='qemu' type='{{ disk.format|default('qcow2') }}'
+{%- for attr in ('cache', 'io', 'discard')
+       if performance['disk_' + attr] is defined %}
+ {{ attr }}='{{ performance['disk_' + attr] }}'
+{%- endfor %}
+{%- if performance.iothreads is defined %}
+ iothread='{{ loop.index0 % performance.iothreads + 1 }}'
+{%- endif %}/>
       <source file='{{ disk.path }}'/>
       <target dev='{{ disk.name }}' bus='virtio'/>
 {% if disk.boot_order is defined %}
@@ -76,6 +108,12 @@ HOST = """
       <mac address='{{ nic.mac }}'/>
       <source network='{{ nic.network_name }}'/>
       <model type='virtio'/>
+{% if performance.nic_queues is defined %}
+      <driver name='vhost' queues='{{ performance.nic_queues }}'/>
+{% endif %}
+{% if nic.mtu is defined %}
+      <mtu size='{{ nic.mtu }}'/>
+{% endif %}
 {% if nic.boot_order is defined %}
       <boot order='{{ nic.boot_order }}'/>
 {% endif %}
@@ -89,10 +127,16 @@ HOST = """
       <target type='serial' port='0'/>
     </console>
     <input type='mouse' bus='ps2'/>
+{% if performance.headless|default(false) %}
+    <video>
+      <model type='none'/>
+    </video>
+{% else %}
     <graphics type='vnc' port='-1' autoport='yes'/>
     <video>
       <model type='cirrus' vram='9216' heads='1'/>
     </video>
+{% endif %}
   </devices>
 </domain>
 """
@@ -20,6 +20,9 @@ NETWORK = """
   <name>{{ name }}</name>
   <uuid>{{ uuid }}</uuid>
   <bridge name='{{ bridge_name }}' stp='on' delay='0'/>
+{% if mtu is defined %}
+  <mtu size='{{ mtu }}'/>
+{% endif %}
   <mac address='{{ mac }}'/>
 {% if dhcp is defined %}
   <forward mode='nat'>
@@ -32,6 +35,9 @@ NETWORK = """
 {%if dhcp.range is defined %}
       <range start='{{ dhcp.range.ipstart }}' end='{{ dhcp.range.ipend }}' />
 {% endif %}
+{% for host in dhcp.hosts|default([]) %}
+      <host mac='{{ host.mac }}' name='{{ host.name }}' ip='{{ host.ip }}'/>
+{% endfor %}
     </dhcp>
   </ip>
 {% endif %}
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+VOLUME = """
+<volume>
+  <name>{{ name }}</name>
+  <capacity unit='bytes'>{{ capacity }}</capacity>
+  <target>
+    <format type='qcow2'/>
+  </target>
+{% if backing_store is defined %}
+  <backingStore>
+    <path>{{ backing_store }}</path>
+    <format type='qcow2'/>
+  </backingStore>
+{% endif %}
+</volume>
+"""
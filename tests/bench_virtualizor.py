@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Measure how virtualizor scales against a simulated hypervisor.
+
+Each run deploys a synthetic infra description with virtualizor.main(), in
+its own process, against a fake libvirt connection and a fake SSH command
+runner. Both add a configurable latency to each call, and the DHCP leases
+show up a configurable time after the domains are started.
+
+    python tests/bench_virtualizor.py --hosts 1 10 100 500
+    python tests/bench_virtualizor.py --json new.json --baseline old.json
+
+With --baseline, the exit code is 1 if a run got slower than the tolerance
+or made more remote calls than the baseline. With --max-wall, it is 1 if a
+run took longer than the given time.
+"""
+
+import argparse
+import json
+import logging
+import os
+import resource
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import warnings
+import xml.etree.ElementTree as ET
+
+import mock
+import yaml
+
+_REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_METADATA_NS = '{http://virtualizor/instance}'
+
+
+class FakeLibvirtError(Exception):
+    pass
+
+
+class FakeDomain(object):
+
+    def __init__(self, conn, xml):
+        self._conn = conn
+        self._xml = xml
+        root = ET.fromstring(xml)
+        self._name = root.findtext('name')
+        self._ncpus = int(root.findtext('vcpu'))
+        self.interfaces = [
+            (i.find('mac').get('address'), i.find('source').get('network'))
+            for i in root.findall('devices/interface')]
+        self._metadata = ET.Element('instance')
+        for element in root.find('metadata/%sinstance' % _METADATA_NS):
+            ET.SubElement(self._metadata, element.tag.replace(
+                _METADATA_NS, '')).text = element.text
+        self.started = None
+
+    def name(self):
+        return self._name
+
+    def create(self):
+        self._conn.libvirt_call()
+        self.started = time.time()
+        return 0
+
+    def destroy(self):
+        self._conn.libvirt_call()
+        self.started = None
+
+    def undefine(self):
+        self._conn.libvirt_call()
+        self._conn.domains.pop(self._name, None)
+
+    def info(self):
+        return [1 if self.started else 5, 0, 0, self._ncpus, 0]
+
+    def XMLDesc(self, flags=0):
+        return self._xml
+
+    def metadata(self, kind, uri, flags=0):
+        return ET.tostring(self._metadata)
+
+
+class FakeNetwork(object):
+
+    def __init__(self, conn, xml):
+        self._conn = conn
+        self._xml = xml
+        root = ET.fromstring(xml)
+        self._name = root.findtext('name')
+        self._bridge = root.find('bridge').get('name')
+
+    def name(self):
+        return self._name
+
+    def bridgeName(self):
+        return self._bridge
+
+    def isActive(self):
+        return True
+
+    def isPersistent(self):
+        return False
+
+    def create(self):
+        pass
+
+    def destroy(self):
+        self._conn.networks.pop(self._name, None)
+
+    def XMLDesc(self, flags=0):
+        return self._xml
+
+    def update(self, command, section, parent_index, xml, flags=0):
+        self._conn.libvirt_call()
+
+    def DHCPLeases(self):
+        self._conn.libvirt_call()
+        leases = []
+        ready = time.time() - self._conn.lease_delay
+        for dom in list(self._conn.domains.values()):
+            if dom.started is None or dom.started > ready:
+                continue
+            for mac, network in dom.interfaces:
+                if network == self._name:
+                    leases.append({'mac': mac, 'ipaddr': '192.168.140.%d' %
+                                   (len(leases) % 250 + 2)})
+        return leases
+
+
+class FakeConnection(object):
+    """A libvirt connection to a hypervisor that only exists in memory."""
+
+    def __init__(self, latency, lease_delay):
+        self.latency = latency
+        self.lease_delay = lease_delay
+        self.domains = {}
+        self.networks = {}
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def libvirt_call(self):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+
+    def listAllNetworks(self):
+        self.libvirt_call()
+        return list(self.networks.values())
+
+    def networkCreateXML(self, xml):
+        self.libvirt_call()
+        network = FakeNetwork(self, xml)
+        self.networks[network.name()] = network
+        return network
+
+    def networkLookupByName(self, name):
+        self.libvirt_call()
+        return self.networks[name]
+
+    def listAllDomains(self, flags=0):
+        self.libvirt_call()
+        return [dom for dom in self.domains.values()
+                if not flags or dom.started]
+
+    def defineXML(self, xml):
+        self.libvirt_call()
+        dom = FakeDomain(self, xml)
+        self.domains[dom.name()] = dom
+        return dom
+
+    def lookupByName(self, name):
+        self.libvirt_call()
+        return self.domains[name]
+
+
+class FakeLibvirt(object):
+    VIR_DOMAIN_METADATA_ELEMENT = 2
+    VIR_DOMAIN_AFFECT_CONFIG = 1
+    VIR_NETWORK_UPDATE_COMMAND_DELETE = 2
+    VIR_NETWORK_UPDATE_COMMAND_ADD_LAST = 3
+    VIR_NETWORK_SECTION_IP_DHCP_HOST = 4
+    VIR_NETWORK_UPDATE_AFFECT_LIVE = 1
+    VIR_NETWORK_UPDATE_AFFECT_CONFIG = 2
+    VIR_CONNECT_LIST_DOMAINS_ACTIVE = 1
+    libvirtError = FakeLibvirtError
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def open(self, uri):
+        return self._conn
+
+
+class FakeRunner(object):
+    """Stand for the SSH commands run on the hypervisor."""
+
+    def __init__(self, latency, marker):
+        self.latency = latency
+        self.calls = 0
+        self.plans = 0
+        self._marker = marker
+        self._lock = threading.Lock()
+
+    def __call__(self, command, output=False, stdin=None):
+        with self._lock:
+            self.calls += 1
+            self.plans += stdin is not None
+        time.sleep(self.latency)
+        if stdin is not None:
+            steps = stdin.count('echo "%s ' % self._marker)
+            return ''.join('%s %d 0\n' % (self._marker, i)
+                           for i in range(steps))
+        if output:
+            if 'MemAvailable' in ' '.join(command):
+                # NOTE: 16 TiB of memory, 1024 CPU and 100 TB of disk
+                return '%d\n1024\n%d\n' % (16 * 1024 ** 3, 100 * 1000 ** 4)
+            return ''
+        return 0
+
+
+def infra_description(hosts):
+    """Return a synthetic infra description of hosts hosts."""
+    description = {'images-url': 'http://images.invalid', 'hosts': {}}
+    for i in range(hosts):
+        description['hosts']['node%d' % i] = {
+            'profile': 'router' if i == 0 else 'openstack-full',
+            'memory': 4 * 1024 ** 2,
+            'ncpus': 2,
+            'disks': [{'image': 'base.qcow2', 'size': '40Gi'},
+                      {'size': '20Gi'}],
+            'nics': [{'mac': '52:54:01:%02x:%02x:01' % (i // 256, i % 256),
+                      'ip': '192.168.%d.%d' % (i // 250, i % 250 + 2),
+                      'netmask': '255.255.0.0',
+                      'network': '192.168.0.0'},
+                     {'mac': '52:54:01:%02x:%02x:02' % (i // 256, i % 256),
+                      'network_name': '__public_network__',
+                      'nat': True}]}
+    return description
+
+
+def run_once(conf):
+    """Deploy conf.run hosts in this process and return the measures."""
+    directory = tempfile.mkdtemp(prefix='virtualizor-bench-')
+    try:
+        return _run_once(conf, directory)
+    finally:
+        shutil.rmtree(directory)
+
+
+def _run_once(conf, directory):
+    input_file = os.path.join(directory, 'virt_platform.yml')
+    with open(input_file, 'w') as fd:
+        yaml.safe_dump(infra_description(conf.run), fd)
+    pub_key_file = os.path.join(directory, 'id_rsa.pub')
+    with open(pub_key_file, 'w') as fd:
+        fd.write('ssh-rsa AAAA bench\n')
+
+    # NOTE: e.g: the yaml.load() deprecation warning
+    warnings.simplefilter('ignore')
+    conn = FakeConnection(conf.libvirt_latency, conf.lease_delay)
+    sys.path.insert(0, _REPO_DIR)
+    with mock.patch.dict('sys.modules', {'libvirt': FakeLibvirt(conn)}):
+        import virtualizor
+        logging.getLogger().setLevel(logging.WARNING)
+        runner = FakeRunner(conf.latency, virtualizor._PLAN_STEP_MARKER)
+        with mock.patch.object(virtualizor.Hypervisor, '_run_command',
+                               runner):
+            start = time.time()
+            virtualizor.main([input_file, 'bench', '--pub-key-file',
+                              pub_key_file, '--parallel',
+                              str(conf.parallel)] +
+                             shlex.split(conf.extra_args))
+            wall = time.time() - start
+    return {'hosts': conf.run,
+            'wall': wall,
+            'remote_calls': runner.calls,
+            'plans': runner.plans,
+            'libvirt_calls': conn.calls,
+            # NOTE: ru_maxrss is in KiB on Linux
+            'peak_rss_mb': resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss / 1024.0}
+
+
+def run(conf, hosts):
+    """Run a deployment in a child process, for a clean peak memory."""
+    command = [sys.executable, os.path.abspath(__file__), '--run', str(hosts),
+               '--latency', str(conf.latency),
+               '--libvirt-latency', str(conf.libvirt_latency),
+               '--lease-delay', str(conf.lease_delay),
+               '--parallel', str(conf.parallel),
+               '--extra-args=%s' % conf.extra_args]
+    output = subprocess.check_output(command)
+    return json.loads(output.decode('utf-8').splitlines()[-1])
+
+
+def compare(results, baseline, tolerance):
+    """Return the regressions of results against the baseline results."""
+    regressions = []
+    previous = dict((r['hosts'], r) for r in baseline)
+    for result in results:
+        old = previous.get(result['hosts'])
+        if old is None:
+            continue
+        if result['wall'] > old['wall'] * (1 + tolerance):
+            regressions.append('%d hosts: %.2fs instead of %.2fs' % (
+                result['hosts'], result['wall'], old['wall']))
+        for key in ('remote_calls', 'libvirt_calls'):
+            if result[key] > old[key]:
+                regressions.append('%d hosts: %d %s instead of %d' % (
+                    result['hosts'], result[key], key, old[key]))
+    return regressions
+
+
+def get_conf(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--hosts', type=int, nargs='+',
+                        default=[1, 10, 100, 500],
+                        help='the sizes of the environments to deploy.')
+    parser.add_argument('--latency', type=float, default=0.002,
+                        help='the duration of each remote command, in '
+                        'seconds.')
+    parser.add_argument('--libvirt-latency', type=float, default=0.001,
+                        help='the duration of each libvirt call, in seconds.')
+    parser.add_argument('--lease-delay', type=float, default=0,
+                        help='the time a domain takes to get its DHCP lease '
+                        'after it is started, in seconds.')
+    parser.add_argument('--parallel', type=int, default=8,
+                        help='the --parallel option of virtualizor.')
+    parser.add_argument('--extra-args', default='',
+                        help='more options for virtualizor, e.g: '
+                        '"--static-leases".')
+    parser.add_argument('--json', metavar='FILE',
+                        help='write the results in FILE.')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='compare the results with the ones of FILE.')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='the accepted slowdown against the baseline.')
+    parser.add_argument('--max-wall', type=float, metavar='SECONDS',
+                        help='the maximum wall time of each run.')
+    parser.add_argument('--run', type=int, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=sys.argv[1:]):
+    conf = get_conf(argv)
+    if conf.run is not None:
+        print(json.dumps(run_once(conf)))
+        return 0
+
+    results = []
+    print('%6s %9s %8s %6s %8s %10s' % ('hosts', 'wall (s)', 'remote',
+                                        'plans', 'libvirt', 'peak (MB)'))
+    for hosts in conf.hosts:
+        result = run(conf, hosts)
+        results.append(result)
+        print('%(hosts)6d %(wall)9.2f %(remote_calls)8d %(plans)6d '
+              '%(libvirt_calls)8d %(peak_rss_mb)10.1f' % result)
+    if conf.json:
+        with open(conf.json, 'w') as fd:
+            json.dump(results, fd, indent=2)
+    regressions = []
+    if conf.baseline:
+        with open(conf.baseline) as fd:
+            regressions += compare(results, json.load(fd), conf.tolerance)
+    if conf.max_wall is not None:
+        regressions += ['%d hosts: %.2fs, more than %.2fs' % (
+            r['hosts'], r['wall'], conf.max_wall)
+            for r in results if r['wall'] > conf.max_wall]
+    for regression in regressions:
+        print('Regression: %s' % regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -16,11 +16,15 @@
 # under the License.
 
 import os
+import shutil
+import tempfile
 import unittest
 
 import collector
 
+from hardware import state
 import mock
+import netaddr
 
 _MODULE_DIR = os.path.dirname(__file__)
 _CONFIG_PATH = "%s/data" % _MODULE_DIR
@@ -31,7 +35,7 @@ class TestCollector(unittest.TestCase):
     @mock.patch("collector.requests")
     def test_collect(self, m_requests):
         m_checksum = mock.Mock()
-        m_requests.get.return_value = m_checksum
+        m_requests.Session.return_value.get.return_value = m_checksum
         m_checksum.text = "test_checksum test_image"
         virt_platform = collector.collect(_CONFIG_PATH, False, "sps_version",
                                           "image_url", "parse_configure_files")
@@ -45,6 +49,251 @@ class TestCollector(unittest.TestCase):
 
         self.assertIn("router", virt_platform["hosts"])
         self.assertIn("images-url", virt_platform)
+        self.assertEqual(virt_platform["hosts"]["router"]["disks"][0][
+            "checksum"], "test_checksum")
+        # NOTE: one request per distinct image
+        self.assertEqual(m_requests.Session.return_value.get.call_count, 2)
+
+    @mock.patch("collector.requests")
+    def test_collect_cache(self, m_requests):
+        m_requests.Session.return_value.get.return_value.text = \
+            "test_checksum test_image"
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        cache_file = os.path.join(tmpdir, "cache")
+        with mock.patch("collector.cmdb.load_cmdb",
+                        wraps=collector.cmdb.load_cmdb) as m_load_cmdb:
+            expected = collector.collect(_CONFIG_PATH, False, "sps_version",
+                                         "image_url", True, cache_file)
+            # NOTE: each CMDB is parsed once for all the stages
+            m_load_cmdb.assert_called_once_with(
+                "%s/edeploy/" % _CONFIG_PATH, "hw1")
+        self.assertTrue(os.path.exists(cache_file))
+
+        with mock.patch("collector.cmdb.load_cmdb") as m_load_cmdb, \
+                mock.patch("collector.state.State.load") as m_load:
+            virt_platform = collector.collect(_CONFIG_PATH, False,
+                                              "sps_version", "image_url",
+                                              True, cache_file)
+        self.assertFalse(m_load_cmdb.called)
+        self.assertFalse(m_load.called)
+        self.assertEqual(virt_platform, expected)
+
+        inputs = collector.Inputs(_CONFIG_PATH, cache_file)
+        signature = inputs.signature()
+        path = "%s/edeploy/hw1.cmdb" % _CONFIG_PATH
+        signature[path] = (signature[path][0] + 1, signature[path][1])
+        with mock.patch.object(collector.Inputs, "signature",
+                               return_value=signature), \
+                mock.patch("collector.cmdb.load_cmdb",
+                           return_value=[]) as m_load_cmdb:
+            inputs = collector.Inputs(_CONFIG_PATH, cache_file)
+        self.assertTrue(m_load_cmdb.called)
+        self.assertEqual(inputs.cmdbs, {"hw1": []})
+
+    @mock.patch("collector.requests.Session")
+    def test_get_checksums(self, m_session):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        cache_file = os.path.join(tmpdir, "checksums.json")
+        m_get = m_session.return_value.get
+        m_get.return_value = mock.Mock(status_code=200,
+                                       text="abcd img.qcow2",
+                                       headers={"ETag": '"1"'})
+        images = ["a.qcow2", "b.qcow2", "a.qcow2"]
+
+        self.assertEqual(collector._get_checksums(None, "v1", images),
+                         {"a.qcow2": None, "b.qcow2": None})
+        checksums = collector._get_checksums("http://img", "v1", images,
+                                             cache_file)
+        self.assertEqual(checksums, {"a.qcow2": "abcd", "b.qcow2": "abcd"})
+        self.assertEqual(sorted(c[0][0] for c in m_get.call_args_list),
+                         ["http://img/v1/a.md5", "http://img/v1/b.md5"])
+        self.assertEqual(m_get.call_args[1]["headers"], {})
+
+        # NOTE: the cached checksums are used without any request
+        m_get.reset_mock()
+        self.assertEqual(collector._get_checksums("http://img", "v1", images,
+                                                  cache_file), checksums)
+        self.assertFalse(m_get.called)
+
+        # then revalidated once they are too old
+        m_get.return_value = mock.Mock(status_code=304)
+        self.assertEqual(collector._get_checksums("http://img", "v1", images,
+                                                  cache_file, max_age=-1),
+                         checksums)
+        self.assertEqual(m_get.call_args[1]["headers"],
+                         {"If-None-Match": '"1"'})
+
+        # and kept when the server is unreachable
+        m_get.side_effect = collector.requests.exceptions.ConnectionError()
+        self.assertEqual(collector._get_checksums("http://img", "v1", images,
+                                                  cache_file, max_age=-1),
+                         checksums)
+        self.assertEqual(collector._get_checksums("http://img", "v2", images,
+                                                  cache_file),
+                         {"a.qcow2": None, "b.qcow2": None})
+
+        m_get.side_effect = collector.requests.exceptions.MissingSchema()
+        self.assertRaises(SystemExit, collector._get_checksums, "img", "v1",
+                          images)
+
+    def test_network_index(self):
+        networks = collector.NetworkIndex(
+            netaddr.IPNetwork(n) for n in ("10.0.0.0/8", "10.1.0.0/16",
+                                           "10.1.2.0/24", "fd00::/64"))
+        self.assertEqual(len(networks), 4)
+        self.assertEqual(networks.lookup("10.1.2.3"),
+                         netaddr.IPNetwork("10.1.2.0/24"))
+        self.assertEqual(networks.lookup("10.1.3.3"),
+                         netaddr.IPNetwork("10.1.0.0/16"))
+        self.assertEqual(networks.lookup("10.2.0.1"),
+                         netaddr.IPNetwork("10.0.0.0/8"))
+        self.assertEqual(networks.lookup("fd00::1"),
+                         netaddr.IPNetwork("fd00::/64"))
+        self.assertIsNone(networks.lookup("192.168.0.1"))
+        networks.add(netaddr.IPNetwork("192.168.0.12/24"))
+        self.assertEqual(str(networks.lookup("192.168.0.1")),
+                         "192.168.0.12/24")
+        self.assertEqual(len(networks), 5)
+
+    def test_get_router_configurations(self):
+        inputs = collector.Inputs(_CONFIG_PATH)
+        inputs.global_conf["config"]["storage_network"] = "192.168.0.0/16"
+        inputs.global_conf["hosts"]["node5"] = {"ip": "10.0.0.5"}
+        inputs.global_conf["hosts"]["node6"] = {"ip": "10.0.0.6"}
+        nics, networks = collector._get_router_configurations(inputs)
+        self.assertEqual(sorted(str(n) for n in nics),
+                         ["10.0.0.5/24", "192.168.0.0/16", "192.168.68.0/24"])
+        self.assertEqual(str(networks.lookup("192.168.68.69")),
+                         "192.168.68.0/24")
+        self.assertEqual(nics[networks.lookup("192.168.68.69")]["ip"],
+                         "192.168.68.3")
+
+    def test_get_files(self):
+        inputs = collector.Inputs(_CONFIG_PATH)
+        inputs.cmdbs["hw2"] = [{"hostname": "node9", "ip": "10.0.0.9"}]
+        inputs.configure_files["hw2"] = None
+        inputs.configure_files["hw1"] = """# -*- python -*-
+config('/etc/sysconfig/network-scripts/ifcfg-eth0').write(\'\'\'DEVICE=eth0
+IPADDR=%(ip)s
+NETMASK=%(netmask)s
+\'\'\')
+config('/etc/fstab').write(\'\'\'%(disk)s /
+\'\'\')
+config('/etc/hostname').write('%(hostname)s\\n')
+config('/etc/motd').write(\'\'\'%(hostname)s\'\'\')
+"""
+        with mock.patch("ast.literal_eval",
+                        wraps=collector.ast.literal_eval) as m_literal_eval:
+            files = collector._get_files(inputs)
+        # NOTE: the templates are parsed once for all the hosts
+        self.assertEqual(m_literal_eval.call_count, 2)
+        self.assertEqual(sorted(files), ["node1", "node2", "node3", "node4"])
+        self.assertEqual(files["node2"], [
+            {"path": "/etc/sysconfig/network-scripts/ifcfg-eth0",
+             "content": "DEVICE=eth0\nIPADDR=192.168.68.48\n"
+                        "NETMASK=255.255.255.0\n"},
+            {"path": "/etc/motd", "content": "node2"}])
+
+    @mock.patch("collector.requests")
+    def test_collect_incremental(self, m_requests):
+        m_requests.Session.return_value.get.return_value.text = \
+            "test_checksum test_image"
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.assertIsNone(collector.load_previous(tmpdir))
+        expected, manifest = collector._collect(_CONFIG_PATH, False,
+                                                "sps_version", "image_url",
+                                                False)
+        self.assertEqual(sorted(manifest["hosts"]),
+                         ["node1", "node2", "node3", "node4"])
+        self.assertIn("edeploy/hw1.cmdb", manifest["inputs"])
+        collector.save_virt_platform(expected, tmpdir, manifest)
+        previous = collector.load_previous(tmpdir)
+        self.assertEqual(previous, (expected, manifest))
+
+        with mock.patch.object(collector.Inputs, "hardware_info") as m_hw:
+            virt_platform, new_manifest = collector._collect(
+                _CONFIG_PATH, False, "sps_version", "image_url", False,
+                previous=previous)
+        self.assertFalse(m_hw.called)
+        self.assertEqual(virt_platform, expected)
+        self.assertEqual(new_manifest, manifest)
+
+        # NOTE: only the hosts whose inputs changed are regenerated
+        previous[1]["hosts"]["node2"] = "outdated"
+        with mock.patch.object(collector.Inputs, "hardware_info",
+                               wraps=collector.Inputs(_CONFIG_PATH)
+                               .hardware_info) as m_hw:
+            virt_platform, new_manifest = collector._collect(
+                _CONFIG_PATH, False, "sps_version", "image_url", False,
+                previous=previous)
+        m_hw.assert_called_once_with("node2")
+        self.assertEqual(virt_platform, expected)
+
+        # and the options are part of the inputs
+        virt_platform, new_manifest = collector._collect(
+            _CONFIG_PATH, True, "sps_version", "image_url", False,
+            previous=previous)
+        self.assertNotEqual(new_manifest, manifest)
+        self.assertIn("image",
+                      virt_platform["hosts"]["node1"]["disks"][0])
+
+    def test_write_file(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "virt_platform.yml")
+        umask = os.umask(0o022)
+        try:
+            collector._write_file(path, b"a")
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o644)
+        os.chmod(path, 0o640)
+        collector._write_file(path, b"b")
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"b")
+        self.assertEqual(os.listdir(tmpdir), ["virt_platform.yml"])
+
+    def test_inputs_configure_files(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        config_path = os.path.join(tmpdir, "etc")
+        shutil.copytree(_CONFIG_PATH, config_path)
+        configure_file = os.path.join(config_path, "edeploy/hw1.configure")
+        with open(configure_file, "w") as f:
+            f.write("# -*- python -*-\n")
+        cache_file = os.path.join(tmpdir, "cache")
+
+        inputs = collector.Inputs(config_path, cache_file,
+                                  read_configure_files=False)
+        self.assertEqual(inputs.configure_files, {})
+        self.assertNotIn(configure_file, inputs.paths())
+        inputs = collector.Inputs(config_path, cache_file)
+        self.assertEqual(inputs.configure_files,
+                         {"hw1": "# -*- python -*-\n"})
+        self.assertIn(configure_file, inputs.paths())
+
+    def test_hardware_private_api(self):
+        # NOTE: Inputs relies on these private helpers of hardware.state,
+        # this test fails when an upgrade of hardware changes them.
+        for name in ("_get_memory", "_get_ncpus", "_get_disks", "_get_nics",
+                     "_load_specs"):
+            self.assertTrue(callable(getattr(state.State, name, None)), name)
+        state_obj = state.State()
+        state_obj.load("%s/edeploy/" % _CONFIG_PATH)
+        try:
+            self.assertEqual(state_obj._data, [("hw1", "*")])
+            expected = dict((hostname, state_obj.hardware_info(hostname))
+                            for hostname in ("node1", "node4", "unknown"))
+        finally:
+            state_obj.unlock()
+        inputs = collector.Inputs(_CONFIG_PATH)
+        for hostname, hardware_info in expected.items():
+            self.assertEqual(inputs.hardware_info(hostname), hardware_info)
+        self.assertIn("disks", expected["node1"])
 
 if __name__ == "__main__":
     unittest.main()
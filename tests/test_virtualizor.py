@@ -14,7 +14,12 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import json
 import mock
+import os
+import shutil
+import subprocess
+import tempfile
 import testtools
 import unittest
 
@@ -45,6 +50,12 @@ class FakeLibvirt(object):
     VIR_DOMAIN_PMSUSPENDED = 7
     VIR_DOMAIN_METADATA_ELEMENT = 2
     VIR_DOMAIN_AFFECT_CONFIG = 1
+    VIR_NETWORK_UPDATE_COMMAND_DELETE = 2
+    VIR_NETWORK_UPDATE_COMMAND_ADD_LAST = 3
+    VIR_NETWORK_SECTION_IP_DHCP_HOST = 4
+    VIR_NETWORK_UPDATE_AFFECT_LIVE = 1
+    VIR_NETWORK_UPDATE_AFFECT_CONFIG = 2
+    VIR_CONNECT_LIST_DOMAINS_ACTIVE = 1
 
     def open(a, b):
         return libvirt_conn
@@ -72,27 +83,783 @@ class TestVirtualizor(testtools.TestCase):
         self.assertRegex(virtualizor.random_mac(),
                          '^([0-9a-fA-F]{2}:){5}([0-9a-fA-F]{2})$')
 
+    @mock.patch('virtualizor.Hypervisor.execute', autospec=True,
+                side_effect=lambda self, plan: [0] * len(plan.steps))
     @mock.patch('virtualizor.subprocess.call')
     @mock.patch('virtualizor.Hypervisor.call', mock.Mock(return_value=0))
     @mock.patch('subprocess.check_output', mock.Mock(return_value=""))
-    def test_main(self, sub_call):
+    def test_main(self, sub_call, execute):
         self.virtualizor.main(['virt_platform_qcow2.yml.sample', 'bar',
                                '--pub-key-file',
                                'virt_platform_qcow2.yml.sample'])
-        self.assertEqual(sub_call.call_count, 10)
+        self.assertEqual(sub_call.call_count, 0)
+        # NOTE: one plan for the hosts of each image
+        self.assertEqual(execute.call_count, 2)
         self.assertEqual(libvirt_conn.networkCreateXML.call_count, 1)
         self.assertEqual(libvirt_conn.defineXML.call_count, 5)
 
+    @mock.patch('virtualizor.Hypervisor.execute', autospec=True,
+                side_effect=lambda self, plan: [0] * len(plan.steps))
     @mock.patch('virtualizor.subprocess.call')
     @mock.patch('virtualizor.Hypervisor.call', mock.Mock(return_value=0))
     @mock.patch('subprocess.check_output', mock.Mock(return_value=""))
-    def test_main_with_replace(self, sub_call):
+    def test_main_with_replace(self, sub_call, execute):
         self.virtualizor.main(['--cleanup', 'virt_platform_qcow2.yml.sample',
                                'bar', '--pub-key-file',
                                'virt_platform_qcow2.yml.sample'])
-        self.assertEqual(sub_call.call_count, 10)
+        self.assertEqual(sub_call.call_count, 0)
+        # NOTE: one plan for the hosts of each image
+        self.assertEqual(execute.call_count, 2)
         self.assertEqual(libvirt_conn.networkCreateXML.call_count, 2)
         self.assertEqual(libvirt_conn.defineXML.call_count, 5)
 
+    @mock.patch('virtualizor.Hypervisor.execute', autospec=True,
+                side_effect=lambda self, plan: [0] * len(plan.steps))
+    @mock.patch('virtualizor.Hypervisor.call', mock.Mock(return_value=0))
+    @mock.patch('subprocess.check_output', mock.Mock(return_value=""))
+    def test_main_trace(self, execute):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        trace_file = os.path.join(directory, 'trace.json')
+        self.virtualizor.main(['virt_platform_qcow2.yml.sample', 'bar',
+                               '--trace', trace_file, '--pub-key-file',
+                               'virt_platform_qcow2.yml.sample'])
+        with open(trace_file) as fd:
+            events = json.load(fd)['traceEvents']
+        phases = set(e['cat'] for e in events)
+        for phase in ('deploy', 'connect', 'networks', 'seed', 'storage',
+                      'start', 'mtu', 'leases', 'remote'):
+            self.assertIn(phase, phases)
+        self.assertIn('start router', [e['name'] for e in events])
+        for event in events:
+            self.assertEqual(event['ph'], 'X')
+            self.assertGreaterEqual(event['dur'], 0)
+
+    def test_tracer(self):
+        tracer = self.virtualizor.Tracer()
+        with tracer.span('download', 'foo.qcow2', host='bar'):
+            pass
+        self.assertRaises(ValueError, self._raise_in_span, tracer)
+        self.assertEqual([span['name'] for span in tracer.spans],
+                         ['download foo.qcow2', 'start'])
+        summary = tracer.summary()
+        self.assertEqual(len(summary), 3)
+        self.assertEqual(sorted(line.split()[0] for line in summary[1:]),
+                         ['download', 'start'])
+        self.assertRegex(summary[1], r'^\w+ +1 +\d+\.\d{3} +\d+\.\d{3}$')
+        self.assertEqual(tracer.chrome_trace()['traceEvents'][0]['args'],
+                         {'host': 'bar'})
+
+    def _raise_in_span(self, tracer):
+        with tracer.span('start'):
+            raise ValueError()
+
+    @mock.patch('virtualizor.subprocess.call', return_value=0)
+    def test_call_reuses_ssh_master(self, sub_call):
+        conf = self.virtualizor.get_conf(['virt_platform_qcow2.yml.sample',
+                                          'bar'])
+        hypervisor = self.virtualizor.Hypervisor(conf, {})
+        hypervisor.call('uname', '-r')
+        command = sub_call.call_args[0][0]
+        self.assertIn('ControlMaster=auto', command)
+        self.assertEqual(command[-3:], ['root@bar', 'uname', '-r'])
+        hypervisor.close()
+
+    @mock.patch('virtualizor.subprocess.Popen')
+    @mock.patch('virtualizor.Hypervisor.call', mock.Mock(return_value=0))
+    def test_execute_plan(self, popen):
+        popen.return_value.communicate.return_value = (
+            b'__virtualizor_step__ 0 0\n__virtualizor_step__ 1 1\n', None)
+        conf = self.virtualizor.get_conf(['virt_platform_qcow2.yml.sample',
+                                          'bar'])
+        hypervisor = self.virtualizor.Hypervisor(conf, {})
+        plan = self.virtualizor.RemotePlan()
+        plan.add('mkdir', '-p', '/tmp/a dir')
+        plan.add_file('/tmp/a dir/meta-data', 'hostname: foo')
+        plan.add('true')
+        status = hypervisor.execute(plan)
+        self.assertEqual(popen.call_count, 1)
+        self.assertEqual(status, [0, 1, 255])
+        self.assertEqual(plan.failures(status),
+                         ["echo aG9zdG5hbWU6IGZvbw== | base64 -d > "
+                          "'/tmp/a dir/meta-data'", 'true'])
+        script = popen.return_value.communicate.call_args[0][0]
+        self.assertIn(b"mkdir -p '/tmp/a dir'", script)
+        hypervisor.close()
+
+    def test_plan_script_stdin(self):
+        plan = self.virtualizor.RemotePlan()
+        plan.add('cat')
+        # NOTE: more than the shell reads from stdin at once
+        for _ in range(1000):
+            plan.add('true')
+        process = subprocess.Popen(['sh', '-s'], stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate(plan.script().encode('utf-8'))
+        # NOTE: cat reads nothing, the next steps are still run
+        self.assertEqual(stderr, b'')
+        self.assertEqual(plan.parse_output(stdout.decode('utf-8')),
+                         [0] * 1001)
+
+    @mock.patch('virtualizor.Hypervisor.call', mock.Mock(return_value=0))
+    def test_cloud_init_image_cache(self):
+        conf = self.virtualizor.get_conf(['virt_platform_qcow2.yml.sample',
+                                          'bar'])
+        hypervisor = self.virtualizor.Hypervisor(conf, {})
+        plans = []
+        for _ in range(2):
+            plans.append(self.virtualizor.RemotePlan())
+            host = self.virtualizor.Host(hypervisor, conf, {
+                'hostname': 'node1',
+                'profile': 'openstack-full',
+                'nics': [{'mac': '52:54:00:01:02:03', 'name': 'eth0'}],
+                'disks': [{'image': 'foo.qcow2', 'size': '1Gi'}]},
+                plan=plans[-1])
+        self.assertEqual(plans[0].steps, plans[1].steps)
+        cached_image = ('/var/lib/libvirt/images/cloud-init-cache/%s.img' %
+                        host.seed_hash)
+        self.assertTrue(plans[0].steps[-2].startswith(
+            'test -s %s || { mkdir' % cached_image))
+        self.assertEqual(plans[0].steps[-1],
+                         'cp %s /var/lib/libvirt/images/'
+                         'default_node1_cloud-init.img' % cached_image)
+        self.assertIn("<driver name='qemu' type='raw'/>",
+                      host.dump_libvirt_xml())
+        hypervisor.close()
+
+    @mock.patch('virtualizor.Hypervisor.call', mock.Mock(return_value=0))
+    def test_performance_settings(self):
+        infra_description = {'performance': {'openstack-full': {
+            'cpu_mode': 'host-passthrough', 'disk_cache': 'none',
+            'disk_io': 'native', 'iothreads': 2, 'headless': True}}}
+        definition = {'hostname': 'node1',
+                      'profile': 'openstack-full',
+                      'performance': {'nic_queues': 2,
+                                      'vcpu_pinning': ['2', '3']},
+                      'nics': [{'mac': '52:54:00:01:02:03', 'name': 'eth0'}],
+                      'disks': [{'size': '1Gi'}, {'size': '1Gi'}]}
+        definition['performance'] = self.virtualizor.performance_settings(
+            infra_description, definition)
+        self.assertEqual(definition['performance']['iothreads'], 2)
+        conf = self.virtualizor.get_conf(['virt_platform_qcow2.yml.sample',
+                                          'bar'])
+        hypervisor = self.virtualizor.Hypervisor(conf, {})
+        self.addCleanup(hypervisor.close)
+        xml = self.virtualizor.ET.fromstring(self.virtualizor.Host(
+            hypervisor, conf, definition,
+            plan=self.virtualizor.RemotePlan()).dump_libvirt_xml())
+        self.assertEqual(xml.find('cpu').get('mode'), 'host-passthrough')
+        self.assertEqual([p.get('cpuset') for p in xml.iter('vcpupin')],
+                         ['2', '3'])
+        self.assertEqual([d.get('iothread') for d in xml.iter('driver')
+                          if d.get('name') == 'qemu'], ['1', '2'])
+        self.assertEqual(xml.find('devices/disk/driver').get('io'), 'native')
+        self.assertEqual(xml.find('devices/interface/driver').get('queues'),
+                         '2')
+        self.assertIsNone(xml.find('devices/graphics'))
+
+        for performance in ({'vcpu_pinning': ['1']}, {'turbo': True},
+                            {'disk_io': 'native'}):
+            self.assertRaises(ValueError,
+                              self.virtualizor.performance_settings, {},
+                              {'performance': performance})
+
+    def test_render_only(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.virtualizor.main(['virt_platform_qcow2.yml.sample',
+                               '--render-only', directory,
+                               '--pub-key-file',
+                               'virt_platform_qcow2.yml.sample'])
+        self.assertEqual(libvirt_conn.mock_calls, [])
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(directory, 'domains'))),
+            ['default_os-ci-test10.xml', 'default_os-ci-test11.xml',
+             'default_os-ci-test12.xml', 'default_os-ci-test4.xml',
+             'default_router.xml'])
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(directory, 'networks'))),
+            ['default_sps.xml', 'nat.xml'])
+        with open(os.path.join(directory, 'cloud-init', 'router',
+                               'user-data')) as fd:
+            self.assertTrue(fd.read().startswith('#cloud-config\n'))
+        with open(os.path.join(directory, 'domains',
+                               'default_router.xml')) as fd:
+            xml = fd.read()
+        self.assertIn('<uuid>%s</uuid>' % self.virtualizor.stable_values(
+            'default_router')['uuid'], xml)
+        self.assertIs(self.virtualizor.get_template('{{ foo }}'),
+                      self.virtualizor.get_template('{{ foo }}'))
+
+    def test_bench(self):
+        from tests import bench_virtualizor
+        conf = bench_virtualizor.get_conf(['--latency', '0',
+                                           '--libvirt-latency', '0'])
+        result = bench_virtualizor.run(conf, 3)
+        self.assertEqual(result['hosts'], 3)
+        self.assertEqual(result['plans'], 1)
+        self.assertGreater(result['libvirt_calls'], 3)
+        self.assertEqual(bench_virtualizor.compare([result], [result], 0),
+                         [])
+        slower = dict(result, wall=result['wall'] * 2 + 1,
+                      remote_calls=result['remote_calls'] + 1)
+        self.assertEqual(len(bench_virtualizor.compare([slower], [result],
+                                                       0.25)), 2)
+
+    def test_size_in_bytes(self):
+        self.assertEqual(self.virtualizor.size_in_bytes('40Gi'), 40 * 10 ** 9)
+        self.assertEqual(self.virtualizor.size_in_bytes('2M'), 2 * 1024 ** 2)
+        self.assertEqual(self.virtualizor.size_in_bytes(1024), 1024)
+        self.assertRaises(ValueError, self.virtualizor.size_in_bytes, '2X')
+
+    @mock.patch('virtualizor.Hypervisor.execute', autospec=True,
+                side_effect=lambda self, plan: [0] * len(plan.steps))
+    @mock.patch('virtualizor.Hypervisor.call', mock.Mock(return_value=0))
+    @mock.patch('subprocess.check_output', mock.Mock(return_value=""))
+    def test_main_with_storage_pool(self, execute):
+        pool = libvirt_conn.storagePoolLookupByName.return_value
+        pool.storageVolLookupByName.side_effect = \
+            self.virtualizor.libvirt.libvirtError
+        pool.createXML.return_value.path.return_value = \
+            '/var/lib/libvirt/images/volume.qcow2'
+        self.virtualizor.main(['virt_platform_qcow2.yml.sample', 'bar',
+                               '--disk-backend', 'pool'])
+        libvirt_conn.storagePoolLookupByName.assert_called_with('default')
+        self.assertEqual(pool.createXML.call_count, 14)
+        volume_xml = [c[0][0] for c in pool.createXML.call_args_list
+                      if 'default_os-ci-test10-000.qcow2' in c[0][0]][0]
+        self.assertIn("<capacity unit='bytes'>40000000000</capacity>",
+                      volume_xml)
+        self.assertIn('<path>/var/lib/libvirt/images/openstack-full-D7-'
+                      'I.1.3.0.img.qcow2</path>', volume_xml)
+        for plan in [c[0][1] for c in execute.call_args_list]:
+            self.assertFalse([step for step in plan.steps
+                              if step.startswith('qemu-img')])
+
+    def test_make_vfat_image(self):
+        image = self.virtualizor.make_vfat_image('cidata', {
+            'user-data': '#cloud-config\n' + 'a: b\n' * 1000,
+            'meta-data': 'local-hostname: node1\n'})
+        self.assertEqual(len(image), 2 * 1024 ** 2)
+        self.assertEqual(image[510:512], b'\x55\xaa')
+        self.assertEqual(image[43:62], b'cidata     FAT12   ')
+        # root directory: the volume label, then a VFAT long name entry and
+        # the short name entry of each file.
+        root = image[7 * 512:]
+        self.assertEqual(root[:11], b'cidata     ')
+        self.assertEqual(root[32:33], b'\x41')
+        self.assertEqual(root[33:43], 'meta-'.encode('utf-16-le'))
+        self.assertEqual(root[64:75], b'META-D~1   ')
+        self.assertEqual(root[128:139], b'USER-D~2   ')
+        self.assertRaises(ValueError, self.virtualizor.make_vfat_image,
+                          'cidata', {'user-data': 'a' * 3 * 1024 ** 2})
+
+        image = self.virtualizor.make_vfat_image('cidata', dict(
+            ('script-%02d.sh' % n, 'true\n') for n in range(12)))
+        root = image[7 * 512:7 * 512 + 512 * 32]
+        short_names = [root[j:j + 11] for j in range(0, len(root), 32)
+                       if root[j + 11:j + 12] == b'\x20']
+        self.assertEqual(len(set(short_names)), 12)
+        self.assertEqual(short_names[8:10], [b'SCRIPT~9   ', b'SCRIP~10   '])
+        for short_name in short_names:
+            # NOTE: 8 characters for the base name and 3 for the extension
+            self.assertEqual(short_name[8:], b'   ')
+
+    @mock.patch('virtualizor.Hypervisor.execute', autospec=True,
+                side_effect=lambda self, plan: [0] * len(plan.steps))
+    @mock.patch('virtualizor.Hypervisor.call', mock.Mock(return_value=0))
+    @mock.patch('subprocess.check_output', mock.Mock(return_value=""))
+    def test_main_parallel(self, execute):
+        self.virtualizor.main(['virt_platform_qcow2.yml.sample', 'bar',
+                               '--parallel', '4',
+                               '--start-first', 'router',
+                               '--start-first', 'install-server'])
+        self.assertEqual(execute.call_count, 3)
+        self.assertEqual(libvirt_conn.defineXML.call_count, 5)
+
+    def test_get_start_waves(self):
+        hosts = {'node1': {'profile': 'openstack-full'},
+                 'node2': {'profile': 'openstack-full'},
+                 'router': {'profile': 'router'},
+                 'os-ci-test4': {'profile': 'install-server'}}
+        self.assertEqual(
+            self.virtualizor.get_start_waves(hosts, ['router',
+                                                     'install-server']),
+            [['router'], ['os-ci-test4'], ['node1', 'node2']])
+        self.assertEqual(self.virtualizor.get_start_waves(hosts, []),
+                         [sorted(hosts)])
+
+    @mock.patch('virtualizor.time.sleep', mock.Mock())
+    @mock.patch('virtualizor.Hypervisor.call', return_value=0)
+    def test_purge_existing_domains(self, call):
+        def domain(name, prefix, state):
+            return mock.Mock(**{
+                'name.return_value': name,
+                'metadata.return_value':
+                    '<domain><prefix>%s</prefix></domain>' % prefix,
+                'XMLDesc.return_value':
+                    "<domain><devices><disk><source file='/images/%s.qcow2'/>"
+                    "</disk><disk><source file='/images/%s_cloud-init.img'/>"
+                    "</disk></devices></domain>" % (name, name),
+                'info.return_value': [state]})
+        domains = [domain('foo_node1', 'foo', 1),
+                   domain('foo_node2', 'foo', 5),
+                   domain('bar_node1', 'bar', 1),
+                   domain('foo_node3', 'foo', 6),
+                   domain('foo_node4', 'foo', 0)]
+        self.addCleanup(setattr, libvirt_conn.listAllDomains, 'return_value',
+                        libvirt_conn.listAllDomains.return_value)
+        libvirt_conn.listAllDomains.return_value = domains
+        conf = self.virtualizor.get_conf(['virt_platform_qcow2.yml.sample',
+                                          'bar'])
+        hypervisor = self.virtualizor.Hypervisor(conf, {})
+        self.assertEqual(
+            sorted(self.virtualizor.index_domains(hypervisor)),
+            ['bar', 'foo'])
+        self.virtualizor.purge_existing_domains(hypervisor, 'foo', 2)
+        self.assertEqual(domains[0].destroy.call_count, 1)
+        self.assertEqual(domains[1].destroy.call_count, 0)
+        for dom in domains[:2]:
+            self.assertEqual(dom.undefine.call_count, 1)
+            self.assertEqual(dom.info.call_count, 1)
+        self.assertEqual(domains[2].undefine.call_count, 0)
+        # NOTE: a crashed domain is destroyed, an unknown state is left as is
+        self.assertEqual(domains[3].destroy.call_count, 1)
+        self.assertEqual(domains[3].undefine.call_count, 1)
+        self.assertEqual(domains[4].destroy.call_count, 0)
+        self.assertEqual(domains[4].undefine.call_count, 0)
+        call.assert_called_with('rm', '-f', '/images/foo_node1.qcow2',
+                                '/images/foo_node1_cloud-init.img',
+                                '/images/foo_node2.qcow2',
+                                '/images/foo_node2_cloud-init.img',
+                                '/images/foo_node3.qcow2',
+                                '/images/foo_node3_cloud-init.img')
+        hypervisor.close()
+
+    @mock.patch('virtualizor.Hypervisor.execute', autospec=True,
+                side_effect=lambda self, plan: [0] * len(plan.steps))
+    @mock.patch('virtualizor.Hypervisor.call', return_value=0)
+    @mock.patch('subprocess.check_output', mock.Mock(return_value=""))
+    def test_main_reconcile(self, call, execute):
+        conf = self.virtualizor.get_conf(['virt_platform_qcow2.yml.sample',
+                                          'bar', '--reconcile'])
+        hosts = self.virtualizor.load_infra_description(
+            'virt_platform_qcow2.yml.sample')['hosts']
+
+        def domain(hostname, fingerprint, state=1):
+            return mock.Mock(**{
+                'name.return_value': 'default_' + hostname,
+                'metadata.return_value':
+                    '<instance><prefix>default</prefix>'
+                    '<hostname>%s</hostname><fingerprint>%s</fingerprint>'
+                    '</instance>' % (hostname, fingerprint),
+                'XMLDesc.return_value':
+                    "<domain><devices><interface><mac address='52:54:00:aa:"
+                    "bb:cc'/></interface><disk><source file='/images/%s.qcow2'"
+                    "/></disk></devices></domain>" % hostname,
+                'info.return_value': [state]})
+        domains = [
+            domain('router', self.virtualizor.host_fingerprint(
+                conf, hosts['router']), state=5),
+            domain('os-ci-test10', 'outdated'),
+            domain('os-ci-test99', 'obsolete')]
+        self.addCleanup(setattr, libvirt_conn.listAllDomains, 'return_value',
+                        libvirt_conn.listAllDomains.return_value)
+        libvirt_conn.listAllDomains.return_value = domains
+        calls = []
+        domains[0].create.side_effect = lambda: calls.append('create')
+        configure_networks = self.virtualizor.Hypervisor.configure_networks
+        with mock.patch('virtualizor.Hypervisor.configure_networks',
+                        autospec=True,
+                        side_effect=lambda self, macs: calls.append(
+                            'networks') or configure_networks(self, macs)):
+            self.virtualizor.main(['virt_platform_qcow2.yml.sample', 'bar',
+                                   '--reconcile'])
+        # NOTE: the networks may be gone after a restart of libvirtd
+        self.assertEqual(calls, ['networks', 'create'])
+        self.assertEqual(domains[0].undefine.call_count, 0)
+        for dom in domains[1:]:
+            self.assertEqual(dom.undefine.call_count, 1)
+        call.assert_any_call('rm', '-f', '/images/os-ci-test10.qcow2',
+                             '/images/os-ci-test99.qcow2')
+        self.assertEqual(libvirt_conn.defineXML.call_count, 4)
+        self.assertNotIn('default_router',
+                         ''.join(c[0][0] for c in
+                                 libvirt_conn.defineXML.call_args_list))
+
+    @mock.patch('virtualizor.Hypervisor.call', mock.Mock(return_value=0))
+    def test_wait_for_leases(self):
+        conf = self.virtualizor.get_conf(['virt_platform_qcow2.yml.sample',
+                                          'bar'])
+        hypervisor = self.virtualizor.Hypervisor(conf, {})
+        hypervisor.public_net = libvirt_conn.networkLookupByName('nat')
+        self.assertEqual(
+            hypervisor.wait_for_leases(['52:54:00:01:02:03',
+                                        '52:54:00:04:05:06'], timeout=0.1),
+            {'52:54:00:01:02:03': '1.2.3.4'})
+        hypervisor.close()
+
+    @mock.patch('virtualizor.subprocess.Popen')
+    @mock.patch('virtualizor.Hypervisor.call', mock.Mock(return_value=0))
+    def test_wait_for_leases_from_file(self, popen):
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, b'1426 52:54:00:01:02:03 1.2.3.4 foo *\n'
+                           b'1427 52:54:00:04:05:06 1.2.3.5 bar *\n')
+        popen.return_value.stdout = os.fdopen(read_fd, 'rb')
+        conf = self.virtualizor.get_conf(['virt_platform_qcow2.yml.sample',
+                                          'bar'])
+        hypervisor = self.virtualizor.Hypervisor(conf, {})
+        hypervisor.public_net = mock.Mock(spec=['bridgeName'])
+        self.assertEqual(
+            hypervisor.wait_for_leases(['52:54:00:04:05:06',
+                                        '52:54:00:01:02:03']),
+            {'52:54:00:01:02:03': '1.2.3.4', '52:54:00:04:05:06': '1.2.3.5'})
+        self.assertEqual(popen.call_count, 1)
+        self.assertEqual(hypervisor.wait_for_leases(['52:54:00:07:08:09'],
+                                                    timeout=0.1), {})
+        popen.return_value.terminate.assert_called_with()
+        os.close(write_fd)
+        hypervisor.close()
+
+    @mock.patch('virtualizor.Hypervisor.execute', autospec=True,
+                side_effect=lambda self, plan: [0] * len(plan.steps))
+    @mock.patch('virtualizor.Hypervisor.wait_for_leases')
+    @mock.patch('virtualizor.Hypervisor.call', mock.Mock(return_value=0))
+    @mock.patch('subprocess.check_output', mock.Mock(return_value=""))
+    def test_main_static_leases(self, wait_for_leases, execute):
+        self.virtualizor.main(['virt_platform_qcow2.yml.sample', 'bar',
+                               '--static-leases'])
+        self.assertEqual(wait_for_leases.call_count, 0)
+        public_network_xml = libvirt_conn.networkCreateXML.call_args_list[0]
+        self.assertRegex(public_network_xml[0][0],
+                         "<host mac='52:54:00:01:02:03' name='default-"
+                         "(router|os-ci-test4)' ip='192.168.140.2'/>")
+
+    @mock.patch('virtualizor.Hypervisor.call', mock.Mock(return_value=0))
+    def test_reserve_public_ips(self):
+        conf = self.virtualizor.get_conf(['virt_platform_qcow2.yml.sample',
+                                          'bar'])
+        hypervisor = self.virtualizor.Hypervisor(conf, {})
+        hypervisor.public_net = mock.Mock(**{
+            'XMLDesc.return_value': """<network><ip><dhcp>
+<range start='1.2.3.2' end='1.2.3.9'/>
+<host mac='52:54:00:00:00:01' name='default-router' ip='1.2.3.2'/>
+<host mac='52:54:00:00:00:02' name='default-node1' ip='1.2.3.3'/>
+<host mac='52:54:00:00:00:03' name='other-node1' ip='1.2.3.5'/>
+</dhcp></ip></network>""",
+            'isPersistent.return_value': False,
+            'DHCPLeases.return_value': [{'mac': '52:54:00:00:00:04',
+                                         'ipaddr': '1.2.3.4'}]})
+        public_ips = hypervisor._reserve_public_ips({
+            '52:54:00:00:00:01': 'default-router',
+            '52:54:00:00:00:05': 'default-node1',
+            '52:54:00:00:00:06': 'default-node2'})
+        self.assertEqual(public_ips, {'52:54:00:00:00:01': '1.2.3.2',
+                                      '52:54:00:00:00:05': '1.2.3.3',
+                                      '52:54:00:00:00:06': '1.2.3.6'})
+        self.assertEqual(hypervisor.public_net.update.call_count, 3)
+        hypervisor.close()
+
+    def test_allocate_ips(self):
+        self.assertRaises(self.virtualizor.Hypervisor.MissingPublicNetwork,
+                          self.virtualizor.allocate_ips,
+                          {'ipstart': '1.2.3.2', 'ipend': '1.2.3.3'},
+                          ['1.2.3.3'], ['mac1', 'mac2'])
+
+    @mock.patch('virtualizor.Hypervisor.call', mock.Mock(return_value=0))
+    def test_place_hosts(self):
+        conf = self.virtualizor.get_conf(['virt_platform_qcow2.yml.sample',
+                                          'a,b'])
+        hypervisors = [self.virtualizor.Hypervisor(conf, {}, target_host)
+                       for target_host in ('a', 'b')]
+        hypervisors[0].free_resources = mock.Mock(
+            return_value={'memory': 10 * 1024 ** 2, 'vcpus': 8})
+        hypervisors[1].free_resources = mock.Mock(
+            return_value={'memory': 20 * 1024 ** 2, 'vcpus': 8})
+        hosts = {'big': {'memory': 16 * 1024 ** 2},
+                 'small1': {'memory': 4 * 1024 ** 2},
+                 'small2': {'memory': 4 * 1024 ** 2},
+                 'small3': {'memory': 4 * 1024 ** 2}}
+        placement = self.virtualizor.place_hosts(hypervisors, hosts, hosts)
+        self.assertEqual(
+            dict((h, placement[h].target_host) for h in placement),
+            {'big': 'b', 'small1': 'a', 'small2': 'a', 'small3': 'b'})
+        hosts['huge'] = {'memory': 32 * 1024 ** 2}
+        self.assertRaises(self.virtualizor.Hypervisor.NotEnoughResources,
+                          self.virtualizor.place_hosts, hypervisors, hosts,
+                          hosts)
+        # NOTE: no need to query the resources of a single hypervisor
+        placement = self.virtualizor.place_hosts(hypervisors[:1], hosts,
+                                                 ['huge'])
+        self.assertEqual(placement, {'huge': hypervisors[0]})
+        self.assertEqual(hypervisors[0].free_resources.call_count, 2)
+
+    @mock.patch('virtualizor.Hypervisor.execute', autospec=True,
+                side_effect=lambda self, plan: [0] * len(plan.steps))
+    @mock.patch('virtualizor.Hypervisor.call', mock.Mock(return_value=0))
+    @mock.patch('virtualizor.Hypervisor.query')
+    def test_verify_mtu(self, query, execute):
+        conf = self.virtualizor.get_conf(['virt_platform_qcow2.yml.sample',
+                                          'bar'])
+        hypervisor = self.virtualizor.Hypervisor(conf, {})
+        self.addCleanup(hypervisor.close)
+        hypervisor.private_net = libvirt_conn.networkLookupByName('sps')
+        query.return_value = (
+            '7: br0: <BROADCAST,MULTICAST,UP> mtu 9000 qdisc noqueue\n'
+            '8: vnet0: <BROADCAST,MULTICAST,UP> mtu 9000 master br0\n'
+            '9: vnet1: <BROADCAST,MULTICAST,UP> mtu 1500 master br0\n'
+            '10: vx42: <BROADCAST,MULTICAST,UP> mtu 1450 master br0\n')
+        self.assertEqual(hypervisor.verify_mtu(), ['vnet1', 'vx42'])
+        self.assertEqual(execute.call_args[0][1].steps,
+                         ['ip link set dev vnet1 mtu 9000',
+                          'ip link set dev vx42 mtu 9000'])
+        xml = self.virtualizor.Network('default_sps',
+                                       {'mtu': 9000}).dump_libvirt_xml()
+        self.assertIn("<mtu size='9000'/>", xml)
+
+    def test_estimate_footprint(self):
+        hosts = self.virtualizor.load_infra_description(
+            'virt_platform_qcow2.yml.sample')['hosts']
+        footprint = self.virtualizor.estimate_footprint(hosts, hosts)
+        self.assertEqual(footprint['memory'], 4 * 8177664 + 8 * 1024 ** 2)
+        self.assertEqual(footprint['vcpus'], 10)
+        self.assertEqual(footprint['disk'], 515 * 1000 ** 3)
+        self.assertEqual(footprint['images'], {
+            'openstack-full-D7-I.1.3.0.img.qcow2': 40 * 1000 ** 3,
+            'install-server-D7-I.1.3.0.img.qcow2': 20 * 1000 ** 3})
+
+    @mock.patch('virtualizor.Hypervisor.call', mock.Mock(return_value=0))
+    @mock.patch('virtualizor.Hypervisor.query')
+    def test_check_capacity(self, query):
+        hosts = {'node1': {'memory': 4 * 1024 ** 2, 'ncpus': 4,
+                           'disks': [{'image': 'a.qcow2', 'size': '10Gi'},
+                                     {'size': '100Gi'}]},
+                 'node2': {'disks': [{'image': 'b.qcow2', 'size': '10Gi'}]}}
+        conf = self.virtualizor.get_conf(['virt_platform_qcow2.yml.sample',
+                                          'bar'])
+        hypervisor = self.virtualizor.Hypervisor(
+            conf, {'images-url': 'http://images'})
+        self.addCleanup(hypervisor.close)
+        self.addCleanup(setattr, libvirt_conn.listAllDomains, 'return_value',
+                        libvirt_conn.listAllDomains.return_value)
+        libvirt_conn.listAllDomains.return_value = [
+            mock.Mock(**{'info.return_value': [1, 0, 0, 6]})]
+        resources = {}
+        # NOTE: the download of b.qcow2 is 2 GB, the size of its disks
+        # does not matter.
+        query.side_effect = lambda command: (
+            '2000000000\n' if command.startswith('wget') else
+            resources['output'])
+        # NOTE: 16 GiB of memory, 4 CPU, 50 GB of disk and a.qcow2 present
+        resources['output'] = '16777216\n4\n50000000000\na.qcow2\n'
+        self.assertTrue(self.virtualizor.check_capacity(
+            hypervisor, hosts, ['node1', 'node2']))
+        self.assertIn('ls -1 -- a.qcow2 b.qcow2',
+                      query.call_args_list[0][0][0])
+        self.assertIn('http://images/b.qcow2', query.call_args[0][0])
+        resources['output'] = '16777216\n4\n3000000000\na.qcow2\n'
+        self.assertTrue(self.virtualizor.check_capacity(
+            hypervisor, hosts, ['node1', 'node2']))
+        resources['output'] = '16777216\n4\n1000000000\na.qcow2\n'
+        self.assertFalse(self.virtualizor.check_capacity(
+            hypervisor, hosts, ['node1', 'node2']))
+        resources['output'] = '16777216\n2\n50000000000\na.qcow2\n'
+        self.assertFalse(self.virtualizor.check_capacity(
+            hypervisor, hosts, ['node1', 'node2']))
+        resources['output'] = ''
+        self.assertTrue(self.virtualizor.check_capacity(
+            hypervisor, hosts, ['node1', 'node2']))
+        # NOTE: an image of unknown size is not counted
+        query.side_effect = lambda command: (
+            '0\n' if command.startswith('wget') else
+            '16777216\n4\n1000000000\na.qcow2\n')
+        self.assertTrue(self.virtualizor.check_capacity(
+            hypervisor, hosts, ['node1', 'node2']))
+
+    @mock.patch('virtualizor.Hypervisor.execute', autospec=True,
+                side_effect=lambda self, plan: [0] * len(plan.steps))
+    @mock.patch('virtualizor.Hypervisor.call', mock.Mock(return_value=0))
+    @mock.patch('virtualizor.Hypervisor.query')
+    def test_main_cpu_allocation_ratio(self, query, execute):
+        self.addCleanup(setattr, libvirt_conn.listAllDomains, 'return_value',
+                        libvirt_conn.listAllDomains.return_value)
+        libvirt_conn.listAllDomains.return_value = []
+        # NOTE: 2 CPUs for the 10 vCPUs of the hosts
+        query.side_effect = lambda *kargs: (
+            '1000000000\n2\n1000000000000\n'
+            if 'MemAvailable' in kargs[0] else '')
+        argv = ['virt_platform_qcow2.yml.sample', 'bar', '--pub-key-file',
+                'virt_platform_qcow2.yml.sample']
+        self.assertRaises(SystemExit, self.virtualizor.main, argv)
+        self.assertEqual(libvirt_conn.defineXML.call_count, 0)
+        self.virtualizor.main(argv + ['--cpu-allocation-ratio', '5'])
+        self.assertEqual(libvirt_conn.defineXML.call_count, 5)
+
+    @mock.patch('virtualizor.socket.gethostbyname',
+                side_effect=lambda name: {'b': '10.0.0.2',
+                                          'c': '10.0.0.3'}[name])
+    @mock.patch('virtualizor.Hypervisor.execute', autospec=True,
+                side_effect=lambda self, plan: [0] * len(plan.steps))
+    @mock.patch('virtualizor.Hypervisor.call', return_value=0)
+    @mock.patch('virtualizor.Hypervisor.query', return_value='9050\n9100\n')
+    def test_connect_private_net(self, query, call, execute, gethostbyname):
+        conf = self.virtualizor.get_conf(['virt_platform_qcow2.yml.sample',
+                                          'a,b,c'])
+        hypervisors = [self.virtualizor.Hypervisor(conf, {}, target_host)
+                       for target_host in ('a', 'b', 'c')]
+        hypervisors[0].private_net = libvirt_conn.networkLookupByName('sps')
+        self.assertTrue(hypervisors[0].connect_private_net(hypervisors[1:]))
+        self.assertIn('route get 10.0.0.3', query.call_args[0][0])
+        steps = execute.call_args[0][1].steps
+        self.assertEqual(len(steps), 4)
+        self.assertRegex(steps[0],
+                         '^ip link add vx[0-9]+ mtu 9000 type vxlan id')
+        self.assertIn('dst 10.0.0.2', steps[1])
+        self.assertIn('dst 10.0.0.3', steps[2])
+        self.assertRegex(steps[3], 'master br0 up$')
+
+        # NOTE: no tunnel when the underlay drops the jumbo frames
+        execute.reset_mock()
+        query.return_value = '9050\n1500\n'
+        self.assertFalse(hypervisors[0].connect_private_net(hypervisors[1:]))
+        query.return_value = '9050\n'
+        self.assertFalse(hypervisors[0].connect_private_net(hypervisors[1:]))
+        self.assertFalse(execute.called)
+
+    @mock.patch('virtualizor.Hypervisor.call', mock.Mock(return_value=0))
+    def test_configure_networks_lock(self):
+        conf = self.virtualizor.get_conf(['virt_platform_qcow2.yml.sample',
+                                          'bar'])
+        hypervisor = self.virtualizor.Hypervisor(conf, {})
+        self.addCleanup(hypervisor.close)
+        clone = hypervisor.clone(
+            self.virtualizor.get_conf(['virt_platform_qcow2.yml.sample',
+                                       'bar', '--prefix', 'other']), {})
+        locked = []
+        with mock.patch.object(self.virtualizor.Hypervisor,
+                               '_configure_networks', autospec=True,
+                               side_effect=lambda self, macs: locked.append(
+                                   hypervisor._network_lock.locked())):
+            clone.configure_networks({})
+        # NOTE: the prefixes of a server configure the networks in turn
+        self.assertEqual(locked, [True])
+        self.assertFalse(hypervisor._network_lock.locked())
+
+    def test_image_probe(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        img = os.path.join(tmpdir, 'a.qcow2')
+
+        def probe():
+            return subprocess.check_output(
+                ['sh', '-c', self.virtualizor._IMAGE_PROBE % {'img': img}]
+            ).decode('utf-8').split()
+        self.assertEqual(probe(), [])
+        with open(img, 'w') as f:
+            f.write('image')
+        # NOTE: an image without its md5 must not fail the probe
+        self.assertEqual(probe(), ['present'])
+        with open(img + '.md5', 'w') as f:
+            f.write('aaa\n')
+        self.assertEqual(probe(), ['present', 'aaa'])
+
+    @mock.patch('virtualizor.Hypervisor.call', return_value=0)
+    @mock.patch('virtualizor.Hypervisor.query')
+    def test_start_downloads(self, query, call):
+        remote_files = {'/var/lib/libvirt/images//cached.qcow2': 'aaa',
+                        '/var/lib/libvirt/images//stale.qcow2': 'bbb'}
+
+        def fake_query(*kargs):
+            if kargs[0].startswith('if test -s'):
+                path = kargs[0].split()[3][:-1]
+                if path in remote_files:
+                    return 'present\n%s\n' % remote_files[path]
+                return ''
+            elif kargs[0] == 'md5sum':
+                return 'ccc %s\n' % kargs[1]
+            return '2000000\n'
+        query.side_effect = fake_query
+        infra_description = {
+            'images-url': 'http://images',
+            'hosts': {
+                'node1': {'disks': [{'image': 'cached.qcow2',
+                                     'checksum': 'aaa'}]},
+                'node2': {'disks': [{'image': 'stale.qcow2',
+                                     'checksum': 'ccc'}, {'size': '1Gi'}]},
+                'node3': {'disks': [{'image': 'new.qcow2',
+                                     'checksum': 'ddd'}]},
+                'node4': {'disks': [{'image': 'new.qcow2',
+                                     'checksum': 'ddd'}]}}}
+        conf = self.virtualizor.get_conf(['virt_platform_qcow2.yml.sample',
+                                          'bar'])
+        hypervisor = self.virtualizor.Hypervisor(conf, infra_description)
+        self.addCleanup(hypervisor.close)
+        pool = self.virtualizor.ThreadPool(2)
+        self.addCleanup(pool.join)
+        self.addCleanup(pool.close)
+        downloads = hypervisor.start_downloads(pool)
+        self.assertEqual(dict((image, result.get())
+                              for image, result in downloads.items()),
+                         {'cached.qcow2': True, 'stale.qcow2': True,
+                          'new.qcow2': False})
+        wget_calls = [c for c in call.call_args_list if c[0][0] == 'wget']
+        self.assertEqual(len(wget_calls), 2)
+        # NOTE: only the images of the given hosts
+        self.assertEqual(sorted(hypervisor.start_downloads(
+            pool, ['node1', 'node3'])), ['cached.qcow2', 'new.qcow2'])
+
+    @mock.patch('virtualizor.Hypervisor.execute', autospec=True,
+                side_effect=lambda self, plan: [0] * len(plan.steps))
+    @mock.patch('virtualizor.Hypervisor.call', mock.Mock(return_value=0))
+    @mock.patch('subprocess.check_output', mock.Mock(return_value=""))
+    @mock.patch('virtualizor.Host.start', side_effect=RuntimeError('boom'))
+    def test_main_start_failure(self, start, execute):
+        pools = []
+        thread_pool = self.virtualizor.ThreadPool
+
+        def new_pool(processes):
+            pools.append(mock.Mock(wraps=thread_pool(processes)))
+            return pools[-1]
+
+        with mock.patch('virtualizor.ThreadPool', side_effect=new_pool):
+            self.assertRaises(RuntimeError, self.virtualizor.main,
+                              ['virt_platform_qcow2.yml.sample', 'bar',
+                               '--pub-key-file',
+                               'virt_platform_qcow2.yml.sample'])
+        # NOTE: the download, start and prepare pools are not waited for
+        terminated = [pool for pool in pools if pool.terminate.called]
+        self.assertEqual(len(terminated), 3)
+        self.assertFalse(any(pool.join.called for pool in terminated))
+
+    @mock.patch('virtualizor.Hypervisor.execute', autospec=True,
+                side_effect=lambda self, plan: [0] * len(plan.steps))
+    @mock.patch('virtualizor.Hypervisor.call', mock.Mock(return_value=0))
+    def test_prepare_hosts(self, execute):
+        conf = self.virtualizor.get_conf(['virt_platform_qcow2.yml.sample',
+                                          'bar'])
+        hypervisor = self.virtualizor.Hypervisor(conf, {})
+        hosts = self.virtualizor.load_infra_description(
+            'virt_platform_qcow2.yml.sample')['hosts']
+        self.assertEqual(
+            self.virtualizor.group_by_images(hosts, sorted(hosts)),
+            [['os-ci-test4', 'router'],
+             ['os-ci-test10', 'os-ci-test11', 'os-ci-test12']])
+        downloads = {
+            'install-server-D7-I.1.3.0.img.qcow2': mock.Mock(**{
+                'get.return_value': True}),
+            'openstack-full-D7-I.1.3.0.img.qcow2': mock.Mock(**{
+                'get.return_value': False})}
+        self.assertIsNone(self.virtualizor.prepare_hosts(
+            hypervisor, conf, hosts, ['os-ci-test10', 'os-ci-test11'],
+            downloads))
+        self.assertEqual(execute.call_count, 0)
+        instances = self.virtualizor.prepare_hosts(
+            hypervisor, conf, hosts, ['os-ci-test4', 'router'], downloads)
+        self.assertEqual([i.hostname for i in instances],
+                         ['os-ci-test4', 'router'])
+        self.assertEqual(execute.call_count, 1)
+        hypervisor.close()
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import sys
+import threading
+import time
+import zlib
+
+import mock
+from six.moves.urllib import error as urllib_error
+from six.moves.urllib import request as urllib_request
+import testtools
+
+
+class TestVirtualizord(testtools.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestVirtualizord, cls).setUpClass()
+        # NOTE: only the modules added here are removed afterwards, the C
+        # extensions they use (e.g: yaml) cannot be imported twice.
+        cls._added_modules = [name for name in ('libvirt', 'virtualizor',
+                                                'virtualizord')
+                              if name not in sys.modules]
+        sys.modules.setdefault('libvirt', mock.Mock())
+        import virtualizord
+        cls.virtualizord = virtualizord
+
+    @classmethod
+    def tearDownClass(cls):
+        for name in cls._added_modules:
+            sys.modules.pop(name, None)
+        super(TestVirtualizord, cls).tearDownClass()
+
+    def setUp(self):
+        super(TestVirtualizord, self).setUp()
+        self.real_hypervisor_class = self.virtualizord.virtualizor.Hypervisor
+        patcher = mock.patch('virtualizor.Hypervisor')
+        self.hypervisor_class = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _wait(self, daemon, job):
+        for _ in range(500):
+            if daemon.job(job.id).finished:
+                return daemon.job(job.id)
+            time.sleep(0.01)
+        self.fail('job %d did not finish' % job.id)
+
+    def _conf(self, *argv):
+        return self.virtualizord.virtualizor.get_conf(
+            ['virt_platform_qcow2.yml.sample'] + list(argv))
+
+    @mock.patch('virtualizor.deploy')
+    def test_deploy_reuses_hypervisor(self, deploy):
+        # NOTE: the call counts of a mock are not thread safe, the calls of
+        # the concurrent jobs are recorded in lists instead.
+        clones = []
+        deploys = []
+        hypervisor = self.hypervisor_class.return_value
+        hypervisor.clone.side_effect = lambda conf, infra: clones.append(
+            conf.prefix)
+        deploy.side_effect = lambda conf, infra, hypervisors: deploys.append(
+            conf.prefix)
+        daemon = self.virtualizord.Daemon()
+        jobs = [daemon.submit('deploy', self._conf('hv1', '--prefix', p),
+                              {'hosts': {}})
+                for p in ('ci1', 'ci2')]
+        for job in jobs:
+            self.assertEqual(self._wait(daemon, job).state, 'done')
+        self.assertEqual(self.hypervisor_class.call_count, 1)
+        self.assertEqual(sorted(clones), ['ci1', 'ci2'])
+        self.assertEqual(sorted(deploys), ['ci1', 'ci2'])
+        self.assertEqual(daemon.status()['hypervisors'],
+                         {'hv1': {'running': 0, 'queued': 0}})
+        daemon.close()
+        hypervisor.close.assert_called_once_with()
+
+    def test_reconnect(self):
+        hypervisors = [mock.Mock(), mock.Mock()]
+        self.hypervisor_class.side_effect = hypervisors
+        daemon = self.virtualizord.Daemon()
+        conf = self._conf('hv1')
+        self.assertIs(daemon.hypervisor('hv1', conf, acquire=True),
+                      hypervisors[0])
+        self.assertIs(daemon.hypervisor('hv1', conf), hypervisors[0])
+        hypervisors[0].conn.isAlive.return_value = 0
+        self.assertIs(daemon.hypervisor('hv1', conf), hypervisors[1])
+        self.assertEqual(self.hypervisor_class.call_count, 2)
+        # NOTE: the running job still uses the SSH master of the old one
+        self.assertFalse(hypervisors[0].close.called)
+        daemon.release(hypervisors[0])
+        hypervisors[0].close.assert_called_once_with()
+        daemon.release(hypervisors[1])
+        self.assertFalse(hypervisors[1].close.called)
+
+        # a Hypervisor without any job is closed right away
+        hypervisors[1].conn.isAlive.return_value = 0
+        self.hypervisor_class.side_effect = None
+        daemon.hypervisor('hv1', conf)
+        hypervisors[1].close.assert_called_once_with()
+
+    @mock.patch('virtualizor.deploy')
+    def test_jobs_of_a_prefix_are_serialized(self, deploy):
+        running = []
+        overlaps = []
+        release = threading.Event()
+
+        def fake_deploy(conf, infra_description, hypervisors):
+            if running:
+                overlaps.append(conf.prefix)
+            running.append(conf.prefix)
+            release.wait(5)
+            running.remove(conf.prefix)
+            if conf.prefix == 'failing':
+                raise SystemExit(1)
+        deploy.side_effect = fake_deploy
+        daemon = self.virtualizord.Daemon(max_jobs=4)
+        jobs = [daemon.submit('deploy', self._conf('hv1', '--prefix', 'ci1'),
+                              {'hosts': {}}) for _ in range(2)]
+        time.sleep(0.1)
+        self.assertEqual(sorted(j['state'] for j in daemon.status()['jobs']),
+                         ['queued', 'running'])
+        release.set()
+        for job in jobs:
+            self.assertEqual(self._wait(daemon, job).exit_code, 0)
+        self.assertEqual(overlaps, [])
+        job = daemon.submit('deploy', self._conf('hv1', '--prefix',
+                                                 'failing'), {'hosts': {}})
+        self.assertEqual(self._wait(daemon, job).state, 'failed')
+
+    @mock.patch('virtualizor.libvirt', mock.Mock())
+    @mock.patch('virtualizor.purge_existing_domains')
+    def test_teardown(self, purge):
+        conf = self._conf('hv1', '--prefix', 'ci1')
+        tunnel = 'vx%d' % (zlib.crc32(b'ci1') & 0xffffff)
+        links = set([tunnel, 'eth0'])
+
+        def call(self, *kargs):
+            if kargs[:3] == ('ip', 'link', 'del'):
+                links.discard(kargs[3])
+            return 0
+
+        with mock.patch.object(self.real_hypervisor_class, 'call',
+                               autospec=True, side_effect=call):
+            hypervisor = self.real_hypervisor_class(conf, {}, 'hv1')
+            self.addCleanup(hypervisor.close)
+            network = mock.Mock()
+            network.name.return_value = 'ci1_sps'
+            hypervisor.conn.listAllNetworks.return_value = [network]
+            self.virtualizord.teardown(hypervisor, conf)
+        purge.assert_called_once_with(hypervisor, 'ci1', conf.parallel)
+        hypervisor.conn.networkLookupByName.assert_called_once_with('ci1_sps')
+        self.assertEqual(links, set(['eth0']))
+
+    @mock.patch('virtualizor.purge_existing_domains')
+    @mock.patch('virtualizor.deploy')
+    def test_http_api(self, deploy, purge):
+        daemon = self.virtualizord.Daemon()
+        server = self.virtualizord.Server(('127.0.0.1', 0), daemon)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:%d' % server.server_address[1]
+
+        def post(path, content):
+            return json.loads(urllib_request.urlopen(
+                url + path, json.dumps(content).encode('utf-8')).read().decode(
+                    'utf-8'))
+
+        job = post('/deploy', {'argv': ['virt_platform_qcow2.yml.sample',
+                                        'hv1', '--prefix', 'ci1']})
+        self.assertEqual(job['prefix'], 'ci1')
+        self._wait(daemon, daemon.job(job['id']))
+        infra_description = deploy.call_args[0][1]
+        self.assertIn('router', infra_description['hosts'])
+        job = post('/teardown', {'argv': ['-', 'hv1', '--prefix', 'ci1']})
+        self._wait(daemon, daemon.job(job['id']))
+        self.assertEqual(purge.call_args[0][1], 'ci1')
+        status = json.loads(urllib_request.urlopen(
+            url + '/jobs/%d' % job['id']).read().decode('utf-8'))
+        self.assertEqual(status['state'], 'done')
+        for path, content in (('/deploy', {'argv': ['--bad']}),
+                              ('/deploy', {}),
+                              ('/nowhere', {})):
+            e = self.assertRaises(urllib_error.HTTPError, post, path, content)
+            self.assertIn(e.code, (400, 404))
@@ -17,17 +17,35 @@
 
 from templates import host as host_template
 from templates import network as network_template
+from templates import volume as volume_template
 
 import argparse
+import base64
+import contextlib
+import copy
+import gzip
+import hashlib
+import io
+import ipaddress
+import json
 import logging
+import os
 import random
 import re
+import select
+import shutil
+import socket
 import string
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import uuid
+import zlib
+
+from multiprocessing.pool import ThreadPool
 
 import jinja2
 import libvirt
@@ -38,6 +56,30 @@ import yaml
 logging.basicConfig(level=logging.DEBUG)
 
 _LIBVIRT_IMAGE_DIR = "/var/lib/libvirt/images/"
+# NOTE: prints "present" and the cached md5 of an image, always exits with 0
+_IMAGE_PROBE = ("if test -s %(img)s; then echo present; "
+                "cat %(img)s.md5 2>/dev/null || true; fi")
+# NOTE: keep the SSH master connection alive between two remote calls
+_SSH_CONTROL_PERSIST = 600
+_EMULATORS = ('/usr/bin/qemu-system-x86_64', '/usr/libexec/qemu-kvm')
+_JINJA_ENV = jinja2.Environment(undefined=jinja2.StrictUndefined)
+_TEMPLATES = {}
+# NOTE: the C emitter of libyaml produces the same documents, much faster
+_YAML_DUMPER = getattr(yaml, 'CDumper', yaml.Dumper)
+_PLAN_STEP_MARKER = "__virtualizor_step__"
+_CLOUD_INIT_CACHE_DIR = "/var/lib/libvirt/images/cloud-init-cache"
+_SECTOR_SIZE = 512
+_DEFAULT_MEMORY = 8 * 1024 ** 2
+_DEFAULT_NCPUS = 2
+# NOTE: the number of vCPU we allocate per physical CPU
+_CPU_ALLOCATION_RATIO = 4
+_VXLAN_PORT = 4789
+# NOTE: the outer Ethernet, IP, UDP and VXLAN headers of a tunneled frame
+_VXLAN_OVERHEAD = 50
+_PRIVATE_NET_MTU = 9000
+_PERFORMANCE_SETTINGS = ('cpu_mode', 'vcpu_pinning', 'numa_node', 'hugepages',
+                         'disk_cache', 'disk_io', 'disk_discard', 'iothreads',
+                         'nic_queues', 'headless')
 
 
 def random_mac():
@@ -61,25 +103,164 @@ def canonical_size(size):
     return new_size
 
 
+def size_in_bytes(size):
+    """Convert a qemu-img size (e.g: 40Gi, 512M or 1024) in bytes."""
+    size = canonical_size(str(size))
+    m = re.search(r'^(\d+)([kKMGT]?)$', size)
+    if not m:
+        raise ValueError("Invalid size: %s" % size)
+    return int(m.group(1)) * 1024 ** ' kMGT'.index(
+        m.group(2).replace('K', 'k') or ' ')
+
+
+def _lfn_checksum(short_name):
+    checksum = 0
+    for c in bytearray(short_name):
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + c) & 0xff
+    return checksum
+
+
+def make_vfat_image(label, files, size=2 * 1024 ** 2):
+    """Build a FAT12 file system image in memory.
+
+    files is a dict with the content of each file of the root directory, the
+    long file names are stored with VFAT entries. This is what mkfs.vfat and
+    mcopy do to build a cloud-init NoCloud seed image.
+    """
+    sectors_per_cluster = 4
+    cluster_size = sectors_per_cluster * _SECTOR_SIZE
+    root_entries = 512
+    root_sectors = root_entries * 32 // _SECTOR_SIZE
+    total_sectors = size // _SECTOR_SIZE
+    max_clusters = (total_sectors - 1 - root_sectors) // sectors_per_cluster
+    fat_sectors = -(-((max_clusters + 2) * 3 // 2 + 1) // _SECTOR_SIZE)
+    data_start = 1 + 2 * fat_sectors + root_sectors
+    clusters = (total_sectors - data_start) // sectors_per_cluster
+
+    image = bytearray(size)
+    fat = bytearray(fat_sectors * _SECTOR_SIZE)
+    root = bytearray(root_sectors * _SECTOR_SIZE)
+    label = label.encode('ascii')[:11].ljust(11)
+
+    def set_fat(cluster, value):
+        offset = cluster * 3 // 2
+        if cluster % 2:
+            fat[offset] = (fat[offset] & 0x0f) | ((value & 0x0f) << 4)
+            fat[offset + 1] = value >> 4
+        else:
+            fat[offset] = value & 0xff
+            fat[offset + 1] = (fat[offset + 1] & 0xf0) | (value >> 8)
+
+    set_fat(0, 0xff8)
+    set_fat(1, 0xfff)
+    # 1980-01-01, the FAT epoch
+    date = (1 << 5) | 1
+    entries = [struct.pack('<11sB10xHHHI', label, 0x08, 0, date, 0, 0)]
+    next_cluster = 2
+    for i, name in enumerate(sorted(files)):
+        content = files[name]
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        needed = -(-len(content) // cluster_size)
+        if next_cluster + needed - 2 > clusters:
+            raise ValueError("%s does not fit in a %d bytes image" % (
+                name, size))
+        first_cluster = next_cluster if needed else 0
+        for n in range(needed):
+            cluster = next_cluster + n
+            set_fat(cluster, 0xfff if n == needed - 1 else cluster + 1)
+            offset = ((data_start + (cluster - 2) * sectors_per_cluster) *
+                      _SECTOR_SIZE)
+            chunk = content[n * cluster_size:(n + 1) * cluster_size]
+            image[offset:offset + len(chunk)] = chunk
+        next_cluster += needed
+
+        stem = re.sub('[^A-Z0-9_-]', '', name.upper())
+        # NOTE: the base name has 8 characters at most, with the suffix
+        suffix = '~%d' % (i + 1)
+        short_name = (stem[:8 - len(suffix)] + suffix).encode(
+            'ascii').ljust(11)
+        checksum = _lfn_checksum(short_name)
+        # NOTE: the long name is split in chunks of 13 UCS-2 characters, a
+        # NUL terminator and 0xFFFF paddings complete the last chunk.
+        long_name = name.encode('utf-16-le') + b'\x00\x00'
+        long_name += b'\xff' * (-len(long_name) % 26)
+        chunks = [long_name[j:j + 26] for j in range(0, len(long_name), 26)]
+        for seq in range(len(chunks), 0, -1):
+            chunk = chunks[seq - 1]
+            order = seq | 0x40 if seq == len(chunks) else seq
+            entries.append(struct.pack(
+                '<B10sBBB12sH4s', order, chunk[:10], 0x0f, 0, checksum,
+                chunk[10:22], 0, chunk[22:26]))
+        entries.append(struct.pack('<11sB10xHHHI', short_name, 0x20, 0, date,
+                                   first_cluster, len(content)))
+
+    root_content = b''.join(entries)
+    if len(root_content) > len(root):
+        raise ValueError("Too many files for the root directory")
+    root[:len(root_content)] = root_content
+
+    boot_sector = struct.pack(
+        '<3s8sHBHBHHBHHHIIBBBI11s8s', b'\xeb\x3c\x90', b'mkfs.fat',
+        _SECTOR_SIZE, sectors_per_cluster, 1, 2, root_entries, total_sectors,
+        0xf8, fat_sectors, 32, 64, 0, 0, 0x80, 0, 0x29,
+        zlib.crc32(bytes(image)) & 0xffffffff, label, b'FAT12   ')
+    image[:len(boot_sector)] = boot_sector
+    image[510:512] = b'\x55\xaa'
+    for n in range(2):
+        offset = (1 + n * fat_sectors) * _SECTOR_SIZE
+        image[offset:offset + len(fat)] = fat
+    offset = (1 + 2 * fat_sectors) * _SECTOR_SIZE
+    image[offset:offset + len(root)] = root
+    return bytes(image)
+
+
+def get_template(source):
+    """Return the compiled jinja2 template, it is compiled only once."""
+    template = _TEMPLATES.get(source)
+    if template is None:
+        template = _TEMPLATES.setdefault(source,
+                                         _JINJA_ENV.from_string(source))
+    return template
+
+
 def get_conf(argv=sys.argv):
     def check_prefix(value):
         if not re.match('^[\._a-zA-Z\d\-]+$', value):
             sys.stderr.write("Invalid value for --prefix parameter\n")
             sys.exit(1)
         return value
+
+    def check_parallel(value):
+        if not re.match('^\d+$', value) or int(value) < 1:
+            sys.stderr.write("Invalid number of workers: %s\n" % value)
+            sys.exit(1)
+        return int(value)
+
+    def check_ratio(value):
+        if not re.match('^\d+(\.\d+)?$', value) or float(value) <= 0:
+            sys.stderr.write("Invalid allocation ratio: %s\n" % value)
+            sys.exit(1)
+        return float(value)
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         description='Deploy a virtual infrastructure.')
-    parser.add_argument('--cleanup', action='store_true',
-                        help='existing resources with the same prefix will be '
-                        'removed first.')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--cleanup', action='store_true',
+                      help='existing resources with the same prefix will be '
+                      'removed first.')
+    mode.add_argument('--reconcile', action='store_true',
+                      help='only recreate the hosts whose definition changed '
+                      'since the previous deployment with the same prefix, '
+                      'the unchanged hosts are kept running.')
     parser.add_argument('input_file', type=str,
                         help='the YAML input file, as generated by '
                         'collector.py.')
-    parser.add_argument('target_host', type=str,
+    parser.add_argument('target_host', type=str, nargs='?',
                         help='the name of the libvirt server. The local user '
                         'must be able to connect to the root account with no '
-                        'password authentification.')
+                        'password authentification. Use a comma separated '
+                        'list to spread the hosts on several servers.')
     parser.add_argument('--pub-key-file', type=str, action='append',
                         default=[],
                         help='the path to the SSH public key file that must '
@@ -97,74 +278,458 @@ def get_conf(argv=sys.argv):
                         'for the install-server. This public network will by '
                         'attached to eth1 interface and IP address is '
                         'associated using the DHCP.')
+    parser.add_argument('--parallel', default=1, type=check_parallel,
+                        help='the number of hosts to start at the same time.')
+    parser.add_argument('--start-first', action='append', default=[],
+                        metavar='PROFILE',
+                        help='start the hosts with this profile before the '
+                        'other ones, e.g: router. Can be repeated, the '
+                        'profiles are started in the given order.')
+    parser.add_argument('--seed-builder', default='local',
+                        choices=['local', 'hypervisor'],
+                        help='where to build the cloud-init seed images. '
+                        'local builds them in memory, hypervisor builds '
+                        'them with mkfs.vfat and mcopy on the hypervisor.')
+    parser.add_argument('--disk-backend', default='qemu-img',
+                        choices=['qemu-img', 'pool'],
+                        help='how to create the disks. qemu-img runs '
+                        'qemu-img on the hypervisor, pool creates them with '
+                        'the libvirt storage pool API.')
+    parser.add_argument('--storage-pool', default='default',
+                        help='the libvirt storage pool of the disks, with '
+                        '--disk-backend pool. Its target path must be '
+                        '%s.' % host_template.HOST_LIBVIRT_IMAGES_LOCATION)
+    parser.add_argument('--check-only', action='store_true',
+                        help='only print the footprint of the environment '
+                        'and the free resources of the hypervisors, nothing '
+                        'is changed on the hypervisors.')
+    parser.add_argument('--cpu-allocation-ratio', type=check_ratio,
+                        default=_CPU_ALLOCATION_RATIO,
+                        help='the number of vCPUs that can be allocated for '
+                        'each CPU of a hypervisor.')
+    parser.add_argument('--parallel-downloads', default=4,
+                        type=check_parallel,
+                        help='the number of images to download at the same '
+                        'time.')
+    parser.add_argument('--lease-timeout', default=None, type=int,
+                        help='the maximum time to wait for the public IP '
+                        'addresses of the hosts, in seconds. By default, '
+                        'virtualizor waits forever.')
+    parser.add_argument('--static-leases', action='store_true',
+                        help='reserve the public IP addresses of the hosts in '
+                        'the public network DHCP server before they boot '
+                        'instead of waiting for their DHCP leases.')
+
+    parser.add_argument('--trace', metavar='FILE',
+                        help='write the duration of each phase, host and '
+                        'remote command in FILE, in the Chrome trace format.')
+    parser.add_argument('--render-only', metavar='DIR',
+                        help='write the libvirt XML and the cloud-init data '
+                        'of the environment in DIR instead of deploying it, '
+                        'no hypervisor is contacted.')
 
     conf = parser.parse_args(argv)
+    if conf.target_host is None and not conf.render_only:
+        parser.error('the target_host argument is required')
     return conf
 
 
+class RemotePlan(object):
+    """A list of commands to run on the hypervisor in a single round trip.
+
+    The steps are shipped as one shell script, each step is run even if the
+    previous one failed and its exit code is reported back.
+    """
+
+    def __init__(self):
+        self.steps = []
+
+    def add(self, *kargs):
+        self.steps.append(' '.join([six.moves.shlex_quote(str(p))
+                                    for p in kargs]))
+
+    def add_file(self, path, content):
+        encoded = base64.b64encode(content.encode('utf-8'))
+        self.steps.append('echo %s | base64 -d > %s' % (
+            encoded.decode('ascii'), six.moves.shlex_quote(path)))
+
+    def add_binary_file(self, path, data):
+        # NOTE: the data are compressed, a file system image is mostly
+        # made of zeros.
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as fd:
+            fd.write(data)
+        self.steps.append('echo %s | base64 -d | gunzip > %s' % (
+            base64.b64encode(buf.getvalue()).decode('ascii'),
+            six.moves.shlex_quote(path)))
+
+    def add_unless_exists(self, path, plan):
+        """Run the steps of another plan, only if path does not exist.
+
+        The steps are chained, the first failure stops the chain.
+        """
+        self.steps.append('test -s %s || { %s; }' % (
+            six.moves.shlex_quote(path), ' && '.join(plan.steps)))
+
+    def script(self):
+        lines = []
+        for i, step in enumerate(self.steps):
+            # NOTE: the script itself is read on stdin, a step must not
+            # read the next steps.
+            lines.append('{ %s; } </dev/null >&2; echo "%s %d $?"' % (
+                step, _PLAN_STEP_MARKER, i))
+        return '\n'.join(lines) + '\n'
+
+    def parse_output(self, stdout):
+        # NOTE: a step that did not report back (e.g: the SSH connection was
+        # lost) is considered as failed.
+        status = [255] * len(self.steps)
+        for line in stdout.splitlines():
+            m = re.search(r'^%s (\d+) (\d+)$' % _PLAN_STEP_MARKER, line)
+            if m:
+                status[int(m.group(1))] = int(m.group(2))
+        return status
+
+    def failures(self, status):
+        return [self.steps[i] for i, code in enumerate(status) if code != 0]
+
+
+class Tracer(object):
+    """Record the duration of the deployment phases.
+
+    Each span belongs to a phase (download, seed, start...), the spans can
+    be exported in the Chrome trace format (chrome://tracing) and summed up
+    by phase.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self.reset()
+
+    def reset(self):
+        self.spans = []
+        self._lock = threading.Lock()
+        self._origin = time.time()
+
+    @contextlib.contextmanager
+    def span(self, phase, name=None, **args):
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            span = {'phase': phase,
+                    'name': '%s %s' % (phase, name) if name else phase,
+                    'start': start,
+                    'duration': time.time() - start,
+                    'thread': threading.current_thread().ident,
+                    'args': args}
+            with self._lock:
+                self.spans.append(span)
+
+    def chrome_trace(self):
+        events = []
+        for span in self.spans:
+            events.append({'name': span['name'],
+                           'cat': span['phase'],
+                           'ph': 'X',
+                           'ts': int((span['start'] - self._origin) * 1e6),
+                           'dur': int(span['duration'] * 1e6),
+                           'pid': os.getpid(),
+                           'tid': span['thread'],
+                           'args': span['args']})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, path):
+        with open(path, 'w') as fd:
+            json.dump(self.chrome_trace(), fd)
+
+    def summary(self):
+        """Return the count, the total and the max duration of each phase.
+
+        The spans of a phase may overlap, e.g: the concurrent downloads, and
+        the remote commands are also part of the other phases.
+        """
+        phases = {}
+        for span in self.spans:
+            count, total, longest = phases.get(span['phase'], (0, 0, 0))
+            phases[span['phase']] = (count + 1, total + span['duration'],
+                                     max(longest, span['duration']))
+        lines = ['%-12s %6s %10s %10s' % ('phase', 'count', 'total (s)',
+                                          'max (s)')]
+        for phase, (count, total, longest) in sorted(
+                six.iteritems(phases), key=lambda p: (-p[1][1], p[0])):
+            lines.append('%-12s %6d %10.3f %10.3f' % (phase, count, total,
+                                                      longest))
+        return lines
+
+
+_TRACER = Tracer()
+
+
 class Hypervisor(object):
-    def __init__(self, conf, infra_description):
+    offline = False
+
+    def __init__(self, conf, infra_description, target_host=None):
         self._conf = conf
+        self.target_host = target_host or conf.target_host
         self.private_net = None
         self.public_net = None
         self._infra_description = infra_description
-        self._vif_seen = []
+        self._storage_pool = None
+        self._storage_pool_lock = threading.Lock()
+        # NOTE: shared by the clones, the deployments of the other prefixes
+        # define the same public network and reserve IPs in it.
+        self._network_lock = threading.Lock()
+        self._ssh_control_dir = tempfile.mkdtemp(prefix='virtualizor-ssh-')
         self.conn = libvirt.open('qemu+ssh://root@%s/system' %
-                                 self._conf.target_host)
+                                 self.target_host)
         self.emulator = self._find_emulator()
         if self.emulator is None:
             logging.error("No emulator found")
             sys.exit(2)
 
     def _find_emulator(self):
-        for location in ('/usr/bin/qemu-system-x86_64',
-                         '/usr/libexec/qemu-kvm'):
+        for location in _EMULATORS:
             if self.call('test', '-f', location) == 0:
                 return location
         return None
 
-    def download_images(self):
+    def start_downloads(self, pool, hostnames=None):
+        """Queue the download of the images in a pool of workers.
+
+        Each image is downloaded once, even if it is used by several hosts,
+        and is verified against its checksum when the infra description
+        provides one. Only the images of hostnames are downloaded, if set.
+        Return a dict with the AsyncResult of the download of each image.
+        """
 
         if "images-url" not in self._infra_description:
             logging.warn("Images url is not provided by the infra description,"
                          " no images will be downloaded from the hypervisor.")
-            return
+            return {}
 
-        images_url = self._infra_description["images-url"]
+        images = {}
         for host in self._infra_description["hosts"]:
+            if hostnames is not None and host not in hostnames:
+                continue
             host_disks = self._infra_description["hosts"][host]["disks"]
             for disk in host_disks:
                 if "image" not in disk:
                     continue
-                libvirt_img = "%s/%s" % (_LIBVIRT_IMAGE_DIR, disk["image"])
-                exist_img = self.call("test", "-s", libvirt_img)
-                if exist_img == 0:
-                    continue
-                wget_status = self.call('wget', '--continue', '--no-verbose',
-                                        '-O', libvirt_img,
-                                        "%s/%s" % (images_url, disk["image"]))
-                if wget_status != 0:
-                    logging.error("Failed to download '%s' from '%s'" %
-                                  (disk["image"], images_url))
-                logging.info("Downloaded image '%s'" % libvirt_img)
-
-    def configure_networks(self):
+                if not images.get(disk["image"]):
+                    images[disk["image"]] = disk.get("checksum")
+
+        return dict((image, pool.apply_async(self.download_image,
+                                             (image, checksum)))
+                    for image, checksum in sorted(six.iteritems(images)))
+
+    def download_image(self, image, checksum=None):
+        with _TRACER.span('download', image, host=self.target_host):
+            return self._download_image(image, checksum)
+
+    def _download_image(self, image, checksum):
+        images_url = self._infra_description["images-url"]
+        libvirt_img = "%s/%s" % (_LIBVIRT_IMAGE_DIR, image)
+        # NOTE: the md5 of a verified image is cached next to the image, so we
+        # don't read the whole image again on the next deployments.
+        cached = self.query(_IMAGE_PROBE % {'img': libvirt_img}).split()
+        if cached and not checksum:
+            return True
+        if cached:
+            if cached[1:2] == [checksum]:
+                return True
+            if len(cached) == 1 and self._md5sum(libvirt_img) == checksum:
+                self.call('echo', checksum, '>', libvirt_img + '.md5')
+                return True
+            logging.warn("Checksum mismatch for '%s', downloading it again" %
+                         libvirt_img)
+            self.call('rm', '-f', libvirt_img, libvirt_img + '.md5')
+
+        logging.info("Downloading image '%s'" % image)
+        start = time.time()
+        wget_status = self.call('wget', '--continue', '--no-verbose',
+                                '-O', libvirt_img,
+                                "%s/%s" % (images_url, image))
+        if wget_status != 0:
+            logging.error("Failed to download '%s' from '%s'" %
+                          (image, images_url))
+            return False
+        duration = max(time.time() - start, 0.001)
+        size = int(self.query('stat', '-c', '%s', libvirt_img) or 0)
+        logging.info("Downloaded image '%s': %.1f MB in %.1fs (%.1f MB/s)" % (
+            libvirt_img, size / 1e6, duration, size / 1e6 / duration))
+
+        if checksum:
+            if self._md5sum(libvirt_img) != checksum:
+                logging.error("Bad checksum for '%s', expected '%s'" % (
+                    libvirt_img, checksum))
+                return False
+            self.call('echo', checksum, '>', libvirt_img + '.md5')
+        return True
+
+    def _md5sum(self, path):
+        output = self.query('md5sum', path).split()
+        return output[0] if output else None
+
+    def download_sizes(self, images):
+        """Return the size of the download of each image, in bytes.
+
+        The sizes are read from the Content-Length of a HEAD request sent
+        from the hypervisor, like the downloads. An unknown size is 0.
+        """
+        if not images or "images-url" not in self._infra_description:
+            return dict((image, 0) for image in images)
+        output = self.query(' '.join(
+            "wget --spider --server-response %s 2>&1 | awk "
+            "'$1 ~ /^HTTP\\// {ok = $2 == 200; n = 0} "
+            "ok && tolower($1) == \"content-length:\" {n = $2} "
+            "END {print n + 0}';"
+            % six.moves.shlex_quote("%s/%s" % (
+                self._infra_description["images-url"], image))
+            for image in images)).split()
+        if (len(output) != len(images) or
+                not all(v.isdigit() for v in output)):
+            logging.warn("Cannot read the size of the images: %s" % output)
+            return dict((image, 0) for image in images)
+        return dict(zip(images, [int(v) for v in output]))
+
+    def free_resources(self, images=()):
+        """Return the free resources of the hypervisor.
+
+        The available memory (KiB), CPUs and space of the image directory
+        are read with a single command, this command also reports which of
+        the images are already present.
+        """
+        output = self.query(
+            "awk '/^MemAvailable:/ {print $2}' /proc/meminfo; nproc; "
+            "df -P -B1 %(dir)s | awk 'NR == 2 {print $4}'; "
+            "cd %(dir)s && ls -1 -- %(images)s 2>/dev/null; true" % {
+                'dir': _LIBVIRT_IMAGE_DIR,
+                'images': ' '.join(six.moves.shlex_quote(image)
+                                   for image in images)}).split('\n')
+        if len(output) < 3 or not all(v.isdigit() for v in output[:3]):
+            raise ValueError("Unexpected output: %s" % '\n'.join(output))
+        memory, cpus, disk = [int(v) for v in output[:3]]
+        allocated = sum(dom.info()[3] for dom in self.conn.listAllDomains(
+            libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE))
+        return {'memory': memory,
+                'vcpus': int(cpus * self._conf.cpu_allocation_ratio) -
+                allocated,
+                'disk': disk,
+                'images': set(image for image in output[3:] if image)}
+
+    def underlay_mtu(self, addresses):
+        """Return the MTU of the interface used to reach each address."""
+        output = self.query(' '.join(
+            "dev=$(ip -o route get %s 2>/dev/null | "
+            "sed -n 's/.* dev \\([^ ]*\\).*/\\1/p'); "
+            "cat /sys/class/net/$dev/mtu 2>/dev/null || echo 0;" % address
+            for address in addresses))
+        mtus = [int(mtu) for mtu in output.split()]
+        if len(mtus) != len(addresses):
+            raise ValueError("Unexpected output: %s" % output)
+        return mtus
+
+    def connect_private_net(self, peers):
+        """Extend the private network to other hypervisors with VXLAN.
+
+        The VXLAN ID is derived from the prefix, the traffic is sent in
+        unicast to each peer. The tunnel carries the frames of the private
+        network as they are, so the underlay needs jumbo frames.
+        """
+        vni = self._private_tunnel_id()
+        name = 'vx%d' % vni
+        addresses = [socket.gethostbyname(peer.target_host) for peer in peers]
+        needed = _PRIVATE_NET_MTU + _VXLAN_OVERHEAD
+        try:
+            mtus = self.underlay_mtu(addresses)
+        except ValueError as e:
+            logging.error("Cannot read the underlay MTU on %s: %s" % (
+                self.target_host, e))
+            return False
+        too_small = [(address, mtu) for address, mtu in zip(addresses, mtus)
+                     if mtu < needed]
+        for address, mtu in too_small:
+            logging.error("The MTU toward %s is %d on %s, the private "
+                          "network needs %d" % (address, mtu,
+                                                self.target_host, needed))
+        if too_small:
+            return False
+        # NOTE: remove the tunnel of a previous deployment
+        self.remove_private_tunnel()
+        plan = RemotePlan()
+        plan.add('ip', 'link', 'add', name, 'mtu', _PRIVATE_NET_MTU, 'type',
+                 'vxlan', 'id', vni, 'dstport', _VXLAN_PORT)
+        for address in addresses:
+            plan.add('bridge', 'fdb', 'append', '00:00:00:00:00:00',
+                     'dev', name, 'dst', address)
+        plan.add('ip', 'link', 'set', name, 'master',
+                 self.private_net.bridgeName(), 'up')
+        failures = plan.failures(self.execute(plan))
+        for step in failures:
+            logging.error("Failed to run '%s' on %s" % (step,
+                                                        self.target_host))
+        return not failures
+
+    def _private_tunnel_id(self):
+        return zlib.crc32(self._conf.prefix.encode('utf-8')) & 0xffffff
+
+    def remove_private_tunnel(self):
+        """Remove the VXLAN device of the private network, if any."""
+        self.call('ip', 'link', 'del', 'vx%d' % self._private_tunnel_id(),
+                  '2>/dev/null')
+
+    def create_volume(self, name, capacity, backing_store=None):
+        """Create a qcow2 volume in the storage pool, return its path.
+
+        The backing store and the final capacity are set in the same call, an
+        existing volume with the same name is replaced.
+        """
+        with self._storage_pool_lock:
+            if self._storage_pool is None:
+                self._storage_pool = self.conn.storagePoolLookupByName(
+                    self._conf.storage_pool)
+                # NOTE: the images are downloaded behind libvirt back
+                self._storage_pool.refresh(0)
+        try:
+            self._storage_pool.storageVolLookupByName(name).delete(0)
+        except libvirt.libvirtError:
+            pass
+        values = {'name': name, 'capacity': capacity}
+        if backing_store:
+            values['backing_store'] = backing_store
+        xml = get_template(volume_template.VOLUME).render(values)
+        return self._storage_pool.createXML(xml, 0).path()
+
+    def configure_networks(self, public_macs=None):
+        """Create the networks.
+
+        public_macs is an optional dict with the name of the host of each
+        MAC address to reserve an IP address for in the public network DHCP
+        server. Return the reserved IP address of each MAC address.
+        """
+        with self._network_lock:
+            return self._configure_networks(public_macs)
+
+    def _configure_networks(self, public_macs):
+        reservations = self.reservations(public_macs or {})
+        public_ips = {}
         existing_networks = [n.name() for n in self.conn.listAllNetworks()]
         # Ensure the public_network is defined, we don't replace this network,
         # even if --replace is used because other VM may by connected to the
         # same networks.
         if self._conf.public_network not in existing_networks:
-            pub_net = Network(self._conf.public_network, {
-                "dhcp": {"address": "192.168.140.1",
-                         "netmask": "255.255.255.0",
-                         "range": {
-                             "ipstart": "192.168.140.2",
-                             "ipend": "192.168.140.254"}}})
+            pub_net, public_ips = self.new_public_network(reservations)
             self.conn.networkCreateXML(pub_net.dump_libvirt_xml())
         self.public_net = self.conn.networkLookupByName(
             self._conf.public_network)
         if not self.public_net.isActive():
             self.public_net.create()
+        if reservations and not public_ips:
+            public_ips = self._reserve_public_ips(reservations)
 
         private_net_name = "%s_sps" % self._conf.prefix
         exists = private_net_name in existing_networks
@@ -174,64 +739,272 @@ class Hypervisor(object):
             exists = False
         if not exists:
             logging.info("Creating network %s." % private_net_name)
-            network = Network(private_net_name, {})
+            network = Network(private_net_name, {'mtu': _PRIVATE_NET_MTU})
             self.conn.networkCreateXML(network.dump_libvirt_xml())
         self.public_net = self.conn.networkLookupByName(
             self._conf.public_network)
         self.private_net = self.conn.networkLookupByName(
             private_net_name)
-
-    def wait_for_lease(self, mac):
-        while True:
-            if not hasattr(self.public_net, "DHCPLeases"):
-                stdout = subprocess.check_output([
-                    'ssh', 'root@%s' % self._conf.target_host, 'cat',
-                    "/var/lib/libvirt/dnsmasq/%s.leases" %
-                    self._conf.public_network])
-                for line in stdout.split('\n'):
-                    m = re.search("^\S+\s%s\s(\S+)\s" % mac, line)
-                    if m:
-                        return(m.group(1))
-
+        return public_ips
+
+    def reservations(self, public_macs):
+        """Return the DHCP host name of each public MAC address."""
+        return dict((mac, "%s-%s" % (self._conf.prefix, hostname))
+                    for mac, hostname in six.iteritems(public_macs))
+
+    def new_public_network(self, reservations, values=None):
+        """Return the definition of a new public network.
+
+        The IP addresses of the reservations are declared in its DHCP
+        server, they are returned with the network.
+        """
+        dhcp = {"address": "192.168.140.1",
+                "netmask": "255.255.255.0",
+                "range": {
+                    "ipstart": "192.168.140.2",
+                    "ipend": "192.168.140.254"},
+                "hosts": []}
+        public_ips = allocate_ips(dhcp['range'], [], reservations)
+        for mac, ip in sorted(six.iteritems(public_ips)):
+            dhcp['hosts'].append({'mac': mac, 'ip': ip,
+                                  'name': reservations[mac]})
+        return (Network(self._conf.public_network,
+                        dict(values or {}, dhcp=dhcp)), public_ips)
+
+    def _reserve_public_ips(self, reservations):
+        root = ET.fromstring(self.public_net.XMLDesc(0))
+        ip_range = root.find('ip/dhcp/range')
+        if ip_range is None:
+            raise Hypervisor.MissingPublicNetwork(
+                "No DHCP range in the %s network" % self._conf.public_network)
+        flags = libvirt.VIR_NETWORK_UPDATE_AFFECT_LIVE
+        if self.public_net.isPersistent():
+            flags |= libvirt.VIR_NETWORK_UPDATE_AFFECT_CONFIG
+
+        public_ips = {}
+        used_ips = []
+        for entry in root.findall('ip/dhcp/host'):
+            if entry.get('mac') in reservations:
+                public_ips[entry.get('mac')] = entry.get('ip')
+            elif entry.get('name') in reservations.values():
+                # NOTE: the host MAC changed since the previous deployment
+                self.public_net.update(
+                    libvirt.VIR_NETWORK_UPDATE_COMMAND_DELETE,
+                    libvirt.VIR_NETWORK_SECTION_IP_DHCP_HOST, -1,
+                    ET.tostring(entry).decode('utf-8'), flags)
             else:
+                used_ips.append(entry.get('ip'))
+        if hasattr(self.public_net, "DHCPLeases"):
+            used_ips += [lease['ipaddr']
+                         for lease in self.public_net.DHCPLeases()]
+
+        pending = [mac for mac in reservations if mac not in public_ips]
+        new_ips = allocate_ips({'ipstart': ip_range.get('start'),
+                                'ipend': ip_range.get('end')},
+                               used_ips + list(public_ips.values()), pending)
+        for mac, ip in sorted(six.iteritems(new_ips)):
+            self.public_net.update(
+                libvirt.VIR_NETWORK_UPDATE_COMMAND_ADD_LAST,
+                libvirt.VIR_NETWORK_SECTION_IP_DHCP_HOST, -1,
+                "<host mac='%s' name='%s' ip='%s'/>" % (
+                    mac, reservations[mac], ip), flags)
+        public_ips.update(new_ips)
+        return public_ips
+
+    def wait_for_leases(self, macs, timeout=None):
+        """Wait for the public network DHCP leases of a set of MAC addresses.
+
+        All the MAC addresses are watched at once. Return a dict with the IP
+        of each MAC address that got a lease before the timeout (in seconds).
+        """
+        pending = set(macs)
+        leases = {}
+        deadline = time.time() + timeout if timeout else None
+        if hasattr(self.public_net, "DHCPLeases"):
+            while pending:
                 for lease in self.public_net.DHCPLeases():
-                    if lease['mac'] == mac:
-                        return lease['ipaddr']
-
-            time.sleep(1)
-
-    def push(self, source, dest):
-        subprocess.call(['scp', '-q', '-r', source,
-                         'root@%s' % self._conf.target_host + ':' + dest])
-
-    def call(self, *kargs):
+                    if lease['mac'] in pending:
+                        leases[lease['mac']] = lease['ipaddr']
+                        pending.discard(lease['mac'])
+                if not pending or (deadline and time.time() > deadline):
+                    break
+                time.sleep(1)
+        elif pending:
+            self._follow_leases_file(pending, leases, deadline)
+        return leases
+
+    def _follow_leases_file(self, pending, leases, deadline):
+        # NOTE: libvirt < 1.2.6 has no DHCPLeases(), we follow the dnsmasq
+        # leases file in a single SSH session instead.
+        process = subprocess.Popen(self._ssh_command(
+            'tail', '-n', '+1', '-F',
+            "/var/lib/libvirt/dnsmasq/%s.leases" %
+            self._conf.public_network), stdout=subprocess.PIPE)
+        buf = b''
+        try:
+            while pending:
+                wait = max(deadline - time.time(), 0) if deadline else None
+                ready, _, _ = select.select([process.stdout], [], [], wait)
+                if not ready:
+                    break
+                # NOTE: we bypass the file object buffer, otherwise select()
+                # would ignore the lines already read in the buffer.
+                data = os.read(process.stdout.fileno(), 4096)
+                if not data:
+                    break
+                lines = (buf + data).split(b'\n')
+                buf = lines.pop()
+                for line in lines:
+                    fields = line.decode('utf-8').split()
+                    if len(fields) > 2 and fields[1] in pending:
+                        leases[fields[1]] = fields[2]
+                        pending.discard(fields[1])
+        finally:
+            process.terminate()
+            process.wait()
+
+    def _ssh_options(self):
+        """Options to share a single multiplexed SSH session.
+
+        The first command opens the master connection, the following ones
+        reuse it and only pay a round trip instead of a full handshake.
+        """
+        return ['-o', 'ControlMaster=auto',
+                '-o', 'ControlPath=%s/%%r@%%h:%%p' % self._ssh_control_dir,
+                '-o', 'ControlPersist=%d' % _SSH_CONTROL_PERSIST]
+
+    def _ssh_command(self, *kargs):
         # NOTE(Gonéri): We do this to please execv:
         # TypeError: execv() arg 2 must contain only strings
         str_kargs = [str(p) for p in list(kargs)]
-        return subprocess.call(['ssh', 'root@%s' % self._conf.target_host] +
-                               str_kargs)
-
-    def set_mtu_on_br(self, brname, mtu='9000'):
-        brctl_show = subprocess.check_output([
-            'ssh', 'root@%s' % self._conf.target_host,
-            'brctl', 'show', brname])
-        for m in re.finditer(r'((virbr\d+-nic|virbr\d+|vnet\d+))', brctl_show):
-            nic = m.group(0)
-            if nic in self._vif_seen:
+        return (['ssh'] + self._ssh_options() +
+                ['root@%s' % self.target_host] + str_kargs)
+
+    def _run(self, command, output=False, stdin=None):
+        start = time.time()
+        name = command[0]
+        for i, arg in enumerate(command[:-1]):
+            if arg.startswith('root@'):
+                name = command[i + 1]
+        try:
+            with _TRACER.span('remote', name, host=self.target_host,
+                              command=' '.join(command)[-200:]):
+                return self._run_command(command, output, stdin)
+        finally:
+            logging.debug("'%s' took %.3fs" % (' '.join(command),
+                                               time.time() - start))
+
+    def _run_command(self, command, output=False, stdin=None):
+        if stdin is not None:
+            process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE)
+            stdout, _ = process.communicate(stdin.encode('utf-8'))
+            return stdout.decode('utf-8')
+        if output:
+            stdout = subprocess.check_output(command)
+            if isinstance(stdout, bytes):
+                stdout = stdout.decode('utf-8')
+            return stdout
+        return subprocess.call(command)
+
+    def query(self, *kargs):
+        """Run a command on the hypervisor and return its output."""
+        return self._run(self._ssh_command(*kargs), output=True)
+
+    def call(self, *kargs):
+        return self._run(self._ssh_command(*kargs))
+
+    def execute(self, plan):
+        """Run a RemotePlan and return the exit code of each step."""
+        if not plan.steps:
+            return []
+        stdout = self._run(self._ssh_command('sh', '-s'),
+                           stdin=plan.script())
+        return plan.parse_output(stdout)
+
+    def clone(self, conf, infra_description):
+        """Return a Hypervisor for another deployment on the same server.
+
+        The clone shares the libvirt connection, the emulator and the SSH
+        master connection, it must not be closed.
+        """
+        hypervisor = copy.copy(self)
+        hypervisor._conf = conf
+        hypervisor._infra_description = infra_description
+        hypervisor.private_net = None
+        hypervisor.public_net = None
+        return hypervisor
+
+    def close(self):
+        """Stop the SSH master connection, if any."""
+        if os.listdir(self._ssh_control_dir):
+            subprocess.call(['ssh'] + self._ssh_options() +
+                            ['-O', 'exit',
+                             'root@%s' % self.target_host])
+        shutil.rmtree(self._ssh_control_dir, ignore_errors=True)
+
+    def verify_mtu(self, mtu=_PRIVATE_NET_MTU):
+        """Ensure the private bridge and its ports use the expected MTU.
+
+        The MTU is set by libvirt from the network and the domain
+        definitions, this pass only fixes the interfaces left behind, e.g:
+        with a private network created by an older version. Return the list
+        of the fixed interfaces.
+        """
+        bridge = self.private_net.bridgeName()
+        output = self.query('ip -o link show dev %(br)s; '
+                            'ip -o link show master %(br)s' % {'br': bridge})
+        plan = RemotePlan()
+        for m in re.finditer(r'^\d+: ([^:@\s]+)[^\n]* mtu (\d+)', output,
+                             re.MULTILINE):
+            nic, current = m.group(1), int(m.group(2))
+            if current == mtu:
                 continue
-            self.call('ip', 'link', 'set', nic, 'mtu', mtu)
-            self._vif_seen.append(nic)
+            logging.warn("Fixing the MTU of %s on %s (%d instead of %d)" % (
+                nic, self.target_host, current, mtu))
+            plan.add('ip', 'link', 'set', 'dev', nic, 'mtu', mtu)
+        if plan.steps:
+            for step in plan.failures(self.execute(plan)):
+                logging.error("Failed to run '%s' on %s" % (
+                    step, self.target_host))
+        return [step.split()[4] for step in plan.steps]
 
     class MissingPublicNetwork(Exception):
         pass
 
+    class NotEnoughResources(Exception):
+        pass
+
+
+class RenderOnlyHypervisor(Hypervisor):
+    """A hypervisor that is never contacted, used to render the XML."""
+
+    offline = True
+
+    def __init__(self, conf, infra_description):
+        self._conf = conf
+        self.target_host = conf.target_host
+        self.private_net = None
+        self.public_net = None
+        self._infra_description = infra_description
+        self.emulator = _EMULATORS[0]
+
+    def create_volume(self, name, capacity, backing_store=None):
+        return "%s/%s" % (host_template.HOST_LIBVIRT_IMAGES_LOCATION, name)
+
+    def close(self):
+        pass
+
 
 class Host(object):
 
-    def __init__(self, hypervisor, conf, host_definition):
+    def __init__(self, hypervisor, conf, host_definition, plan=None):
         self.hypervisor = hypervisor
         self.conf = conf
         self.dom = None
+        # NOTE: without a shared plan, the storage operations of the host
+        # are run as soon as the host is initialized.
+        self.plan = plan or RemotePlan()
         self.hostname = host_definition['hostname']
         self.files = host_definition.get('files', [])
         self.bootcmd = host_definition.get('bootcmd', [])
@@ -244,13 +1017,17 @@ class Host(object):
                          self.hostname_with_prefix,
                      'uuid': str(uuid.uuid1()),
                      'emulator': self.hypervisor.emulator,
-                     'memory': 8 * 1024 ** 2,
-                     'ncpus': 2,
+                     'memory': _DEFAULT_MEMORY,
+                     'ncpus': _DEFAULT_NCPUS,
                      'cpus': [],
                      'disks': [],
                      'nics': [],
-                     'prefix': conf.prefix}
+                     'prefix': conf.prefix,
+                     'performance': host_definition.get('performance', {}),
+                     'fingerprint': host_fingerprint(conf, host_definition)}
         self.disk_cpt = 0
+        self.seed_hash = None
+        self.cloud_init = {}
 
         for k in ('uuid', 'serial', 'product_name',
                   'memory', 'ncpus', 'profile'):
@@ -258,8 +1035,7 @@ class Host(object):
                 continue
             self.meta[k] = host_definition[k]
 
-        env = jinja2.Environment(undefined=jinja2.StrictUndefined)
-        self.template = env.from_string(host_template.HOST)
+        self.template = get_template(host_template.HOST)
 
         for nic in host_definition['nics']:
             self._register_nic(nic)
@@ -267,11 +1043,17 @@ class Host(object):
             self._initialize_disk(disk)
             self._register_disk(disk)
         if 'image' in host_definition['disks'][0]:
-            cloud_init_image = self._create_cloud_init_image()
+            with _TRACER.span('seed', self.hostname):
+                cloud_init_image = self._create_cloud_init_image()
             self._register_disk(cloud_init_image)
 
         self.meta['disks'][0]['boot_order'] = 1
 
+        if plan is None:
+            failures = self.plan.failures(self.hypervisor.execute(self.plan))
+            for step in failures:
+                logging.error("Failed to run '%s'" % step)
+
     def _create_cloud_init_image(self):
 
         ssh_keys = []
@@ -289,7 +1071,6 @@ class Host(object):
             'DBATTz71eX2snTz+dv+Ei7OFMYl0Rf+7uPCJ3GdhvMXI92CziMIcMB'
             'yKpSiuWB3/LDoezTPYhgbEP0I+zqyHHxpGZUsYx/5ic5RAdUPUeLQW'
             'sEX unsecure')
-        env = jinja2.Environment(undefined=jinja2.StrictUndefined)
         user_data = {
             'users': [
                 {
@@ -392,51 +1173,92 @@ class Host(object):
         user_data['write_files'] += self.write_files
 
         contents = {
-            'user-data': "#cloud-config\n" + yaml.dump(user_data),
-            'meta-data': env.from_string(host_template.META_DATA).render({
+            'user-data': "#cloud-config\n" + yaml.dump(
+                user_data, Dumper=_YAML_DUMPER),
+            'meta-data': get_template(host_template.META_DATA).render({
                 'hostname': self.hostname
             })}
-        # TODO(Gonéri): use mktemp
-        data_dir = "/tmp/%s_data" % self.hostname_with_prefix
-        self.hypervisor.call("mkdir", "-p", data_dir)
+        # NOTE: the seed images are cached on the hypervisor, by content, so
+        # an unchanged host reuses the seed image of the previous deployment.
+        checksum = hashlib.sha256()
         for name in sorted(contents):
-            fd = tempfile.NamedTemporaryFile()
-            fd.write(contents[name]),
-            fd.seek(0)
-            fd.flush()
-            self.hypervisor.push(fd.name, data_dir + '/' + name)
-
-        image = '%s/%s_cloud-init.qcow2' % (
+            checksum.update(contents[name].encode('utf-8'))
+        self.seed_hash = checksum.hexdigest()
+        self.cloud_init = contents
+        if self.conf.seed_builder == 'local':
+            seed_format = 'raw'
+            cached_image = '%s/%s.img' % (_CLOUD_INIT_CACHE_DIR,
+                                          self.seed_hash)
+        else:
+            seed_format = 'qcow2'
+            cached_image = '%s/%s.qcow2' % (_CLOUD_INIT_CACHE_DIR,
+                                            self.seed_hash)
+        if not self.hypervisor.offline:
+            self.plan.add_unless_exists(
+                cached_image, self._build_seed_image(contents, cached_image))
+
+        image = '%s/%s_cloud-init.%s' % (
                 host_template.HOST_LIBVIRT_IMAGES_LOCATION,
-                self.hostname_with_prefix)
-        self.hypervisor.call(
-            'truncate', '--size', '2M', image + '.tmp')
-        self.hypervisor.call(
-            'mkfs.vfat', '-n', 'cidata', image + '.tmp')
-        self.hypervisor.call(
-            'mcopy', '-oi', image + '.tmp',
-            data_dir + '/user-data', data_dir + '/meta-data', '::')
-        self.hypervisor.call(
-            'qemu-img', 'convert', '-O', 'qcow2', image + '.tmp', image)
-        self.hypervisor.call(
-            'rm', image + '.tmp')
-        return {'path': image}
+                self.hostname_with_prefix,
+                'img' if seed_format == 'raw' else 'qcow2')
+        self.plan.add('cp', cached_image, image)
+        return {'path': image, 'format': seed_format}
+
+    def _build_seed_image(self, contents, cached_image):
+        build = RemotePlan()
+        if self.conf.seed_builder == 'local':
+            # NOTE: the seed is built in memory and sent with the plan, this
+            # way the hypervisor does not need mkfs.vfat and mcopy.
+            tmp_image = '%s.%s' % (cached_image, self.hostname_with_prefix)
+            build.add("mkdir", "-p", _CLOUD_INIT_CACHE_DIR)
+            build.add_binary_file(tmp_image,
+                                  make_vfat_image('cidata', contents))
+            build.add('mv', tmp_image, cached_image)
+        else:
+            # TODO(Gonéri): use mktemp
+            data_dir = "/tmp/%s_data" % self.hostname_with_prefix
+            build.add("mkdir", "-p", data_dir, _CLOUD_INIT_CACHE_DIR)
+            for name in sorted(contents):
+                build.add_file(data_dir + '/' + name, contents[name])
+            build.add(
+                'truncate', '--size', '2M', data_dir + '/seed.img')
+            build.add(
+                'mkfs.vfat', '-n', 'cidata', data_dir + '/seed.img')
+            build.add(
+                'mcopy', '-oi', data_dir + '/seed.img',
+                data_dir + '/user-data', data_dir + '/meta-data', '::')
+            build.add(
+                'qemu-img', 'convert', '-O', 'qcow2', data_dir + '/seed.img',
+                data_dir + '/seed.qcow2')
+            build.add(
+                'mv', data_dir + '/seed.qcow2', cached_image)
+            build.add(
+                'rm', '-r', data_dir)
+        return build
 
     def _initialize_disk(self, disk):
         disk_cpt = len(self.meta['disks'])
         filename = "%s-%03d.qcow2" % (self.hostname_with_prefix, disk_cpt)
+        if self.conf.disk_backend == 'pool':
+            backing_store = None
+            if 'image' in disk:
+                backing_store = "%s/%s" % (
+                    host_template.HOST_LIBVIRT_IMAGES_LOCATION, disk['image'])
+            disk['path'] = self.hypervisor.create_volume(
+                filename, size_in_bytes(disk['size']), backing_store)
+            return
         if 'image' in disk:
-            self.hypervisor.call(
+            self.plan.add(
                 'qemu-img', 'create', '-q', '-f', 'qcow2',
                 '-b', disk['image'],
                 host_template.HOST_LIBVIRT_IMAGES_LOCATION + '/' + filename,
                 canonical_size(disk['size']))
-            self.hypervisor.call(
+            self.plan.add(
                 'qemu-img', 'resize', '-q',
                 host_template.HOST_LIBVIRT_IMAGES_LOCATION + '/' + filename,
                 canonical_size(disk['size']))
         else:
-            self.hypervisor.call(
+            self.plan.add(
                 'qemu-img', 'create', '-q', '-f', 'qcow2',
                 host_template.HOST_LIBVIRT_IMAGES_LOCATION + '/' + filename,
                 canonical_size(disk['size']))
@@ -462,6 +1284,8 @@ class Host(object):
         nic.setdefault('pxe', False)
         if nic['network_name'] == '__public_network__':
             nic['network_name'] = self.conf.public_network
+        if nic['network_name'] == '%s_sps' % self.conf.prefix:
+            nic.setdefault('mtu', _PRIVATE_NET_MTU)
         if nic['ip']:
             nic['bootproto'] = 'static'
         if nic['pxe'] is True:
@@ -473,11 +1297,12 @@ class Host(object):
         return self.template.render(self.meta)
 
     def start(self):
-        self.hypervisor.conn.defineXML(self.dump_libvirt_xml())
-        self.dom = self.hypervisor.conn.lookupByName(self.hostname_with_prefix)
-        self.dom.create()
-        self.hypervisor.set_mtu_on_br(
-            self.hypervisor.private_net.bridgeName(), 9000)
+        with _TRACER.span('start', self.hostname,
+                          host=self.hypervisor.target_host):
+            self.hypervisor.conn.defineXML(self.dump_libvirt_xml())
+            self.dom = self.hypervisor.conn.lookupByName(
+                self.hostname_with_prefix)
+            self.dom.create()
 
 
 class Network(object):
@@ -489,43 +1314,173 @@ class Network(object):
             'mac': random_mac(),
             'bridge_name': 'virbr%d' % random.randrange(0, 0xffffffff)}
 
-        for k in ('uuid', 'mac', 'ips', 'dhcp'):
+        for k in ('uuid', 'mac', 'bridge_name', 'ips', 'dhcp', 'mtu'):
             if k not in network_definition:
                 continue
             self._template_values[k] = network_definition[k]
 
-        env = jinja2.Environment(undefined=jinja2.StrictUndefined)
-        self._template = env.from_string(network_template.NETWORK)
+        self._template = get_template(network_template.NETWORK)
 
     def dump_libvirt_xml(self):
         return self._template.render(self._template_values)
 
 
-def load_infra_description(input_file):
+def allocate_ips(ip_range, used_ips, macs):
+    """Pick a free IP address in ip_range for each MAC address."""
+    used_ips = set(used_ips)
+    ip = ipaddress.ip_address(six.text_type(ip_range['ipstart']))
+    ipend = ipaddress.ip_address(six.text_type(ip_range['ipend']))
+    allocation = {}
+    for mac in sorted(macs):
+        while str(ip) in used_ips:
+            ip += 1
+        if ip > ipend:
+            raise Hypervisor.MissingPublicNetwork(
+                "No free IP address left between %s and %s" % (
+                    ip_range['ipstart'], ip_range['ipend']))
+        allocation[mac] = str(ip)
+        ip += 1
+    return allocation
+
+
+def get_public_macs(conf, hosts):
+    """Return the host name of each NIC configured by the public DHCP."""
+    public_macs = {}
+    for hostname, host_description in six.iteritems(hosts):
+        for n in host_description['nics']:
+            if n.get('network_name') not in ('__public_network__',
+                                             conf.public_network):
+                continue
+            if n.get('ip') or n.get('bootproto', 'dhcp') != 'dhcp':
+                continue
+            public_macs[n['mac']] = hostname
+    return public_macs
+
+
+def load_infra_description(input_file, stable_macs=False):
     infra_description = yaml.load(open(input_file, 'r'))
+    return prepare_infra_description(infra_description, stable_macs)
+
+
+def prepare_infra_description(infra_description, stable_macs=False):
+    """Complete the host definitions of an infra description.
 
+    The missing MAC addresses are random, unless stable_macs is set, then
+    they are derived from the host name and the NIC index.
+    """
     for hostname, definition in six.iteritems(infra_description['hosts']):
+        performance = performance_settings(infra_description, definition)
+        if performance:
+            definition['performance'] = performance
+        # NOTE: the fingerprint is computed before the random values are
+        # added, it only changes when the host definition changes.
+        definition['fingerprint'] = hashlib.sha256(json.dumps(
+            definition, sort_keys=True, default=str).encode(
+                'utf-8')).hexdigest()
         i = 0
         # Add the missing MAC because we use them later to know then the DHCP
         # give the IP
         for n in definition["nics"]:
+            if stable_macs:
+                mac = stable_values('%s/%d' % (hostname, i))['mac']
+            else:
+                mac = random_mac()
             # TODO(Gonéri): to move in _register_nic
-            n.setdefault('mac', random_mac())
+            n.setdefault('mac', mac)
             n.setdefault('name', 'eth%d' % i)
             # NOTE(Gonéri): hardware can return mac == none when the MAC is not
             # defined.
             if n['mac'] == 'none':
-                n['mac'] = random_mac()
+                n['mac'] = mac
             if 'vlan' in n:
                 n['name'] += ('.%s' % n['vlan'])
             i += 1
     return infra_description
 
 
-def purge_existing_domains(hypervisor, prefix):
-    logging.info("Cleaning the %s prefix up on the hypervisor" % prefix)
-    existing_domains = [d for d in hypervisor.conn.listAllDomains()]
-    for dom in existing_domains:
+def performance_settings(infra_description, host_definition):
+    """Return the performance settings of a host.
+
+    The settings of the host profile, from the 'performance' section of the
+    infra description, are overridden by the ones of the host.
+    """
+    settings = dict(infra_description.get('performance', {}).get(
+        host_definition.get('profile'), {}))
+    settings.update(host_definition.get('performance', {}))
+    unknown = set(settings) - set(_PERFORMANCE_SETTINGS)
+    if unknown:
+        raise ValueError("Unknown performance settings: %s" %
+                         ', '.join(sorted(unknown)))
+    ncpus = host_definition.get('ncpus', _DEFAULT_NCPUS)
+    if len(settings.get('vcpu_pinning', [None] * ncpus)) != ncpus:
+        raise ValueError("vcpu_pinning needs one entry per vCPU (%d)" %
+                         ncpus)
+    if settings.get('disk_io') == 'native' and \
+            settings.get('disk_cache') not in ('none', 'directsync'):
+        raise ValueError("disk_io 'native' needs the 'none' or 'directsync' "
+                         "disk_cache")
+    return settings
+
+
+def host_fingerprint(conf, host_definition):
+    """Hash of everything the domain, the disks and the seed of a host use."""
+    checksum = hashlib.sha256()
+    for value in (host_definition.get('fingerprint', ''), conf.prefix,
+                  conf.public_network, conf.seed_builder, conf.disk_backend,
+                  host_template.HOST, host_template.META_DATA):
+        checksum.update(value.encode('utf-8'))
+    for path in conf.pub_key_file:
+        with open(path, 'rb') as fd:
+            checksum.update(fd.read())
+    return checksum.hexdigest()
+
+
+def reconcile_domains(hypervisor, conf, hosts):
+    """Compare the hosts with the domains of the prefix on the hypervisor.
+
+    The domains of the hosts that changed or were removed are purged, the
+    unchanged ones are kept and get back their MAC addresses. Return the
+    names of the hosts to create and the kept domains to start, they can
+    only be started once the networks are configured.
+    """
+    to_create = set(hosts)
+    to_purge = []
+    to_start = []
+    for dom, metadata in index_domains(hypervisor).get(conf.prefix, []):
+        hostname = metadata.findtext('hostname')
+        fingerprint = metadata.findtext('fingerprint')
+        if hostname not in to_create or \
+                fingerprint != host_fingerprint(conf, hosts[hostname]):
+            to_purge.append(dom)
+            continue
+        logging.info("Host '%s' is unchanged, keeping it" % hostname)
+        to_create.discard(hostname)
+        root = ET.fromstring(dom.XMLDesc(0))
+        macs = [mac.get('address')
+                for mac in root.findall('devices/interface/mac')]
+        for nic, mac in zip(hosts[hostname]['nics'], macs):
+            nic['mac'] = mac
+        if dom.info()[0] == libvirt.VIR_DOMAIN_SHUTOFF:
+            to_start.append(dom)
+
+    pool = ThreadPool(conf.parallel)
+    try:
+        paths = sum(pool.map(purge_domain, to_purge), [])
+    finally:
+        pool.close()
+        pool.join()
+    if paths:
+        hypervisor.call('rm', '-f', *sorted(set(paths)))
+    return sorted(to_create), to_start
+
+
+def index_domains(hypervisor):
+    """Return the domains of each virtualizor prefix, in a single pass.
+
+    Each domain comes with the root element of its virtualizor metadata.
+    """
+    index = {}
+    for dom in hypervisor.conn.listAllDomains():
         try:
             metadata = dom.metadata(
                 libvirt.VIR_DOMAIN_METADATA_ELEMENT,
@@ -542,49 +1497,410 @@ def purge_existing_domains(hypervisor, prefix):
             dom_prefix = root.find('prefix').text
         except AttributeError:
             continue
-        if prefix == dom_prefix:
-            logging.debug("purging domain %s" % dom.name())
-            if dom.info()[0] in [libvirt.VIR_DOMAIN_RUNNING,
-                                 libvirt.VIR_DOMAIN_PAUSED]:
-                dom.destroy()
-            if dom.info()[0] in [libvirt.VIR_DOMAIN_SHUTOFF]:
-                dom.undefine()
+        index.setdefault(dom_prefix, []).append((dom, root))
+    return index
+
+
+def purge_domain(dom):
+    """Destroy and undefine a domain, return the paths of its disks."""
+    logging.debug("purging domain %s" % dom.name())
+    root = ET.fromstring(dom.XMLDesc(0))
+    paths = [source.get('file')
+             for source in root.findall('devices/disk/source')
+             if source.get('file')]
+    state = dom.info()[0]
+    if state in [libvirt.VIR_DOMAIN_RUNNING,
+                 libvirt.VIR_DOMAIN_BLOCKED,
+                 libvirt.VIR_DOMAIN_PAUSED,
+                 libvirt.VIR_DOMAIN_SHUTDOWN,
+                 libvirt.VIR_DOMAIN_CRASHED,
+                 libvirt.VIR_DOMAIN_PMSUSPENDED]:
+        dom.destroy()
+        state = libvirt.VIR_DOMAIN_SHUTOFF
+    if state not in [libvirt.VIR_DOMAIN_SHUTOFF]:
+        # NOTE: the disks of a domain that still exists are kept
+        logging.warn("Cannot purge domain %s in state %d" % (dom.name(),
+                                                             state))
+        return []
+    dom.undefine()
+    return paths
+
+
+def purge_existing_domains(hypervisor, prefix, parallel=1):
+    logging.info("Cleaning the %s prefix up on the hypervisor" % prefix)
+    start = time.time()
+    domains = [dom for dom, _ in index_domains(hypervisor).get(prefix, [])]
+    pool = ThreadPool(parallel)
+    try:
+        paths = sum(pool.map(purge_domain, domains), [])
+    finally:
+        pool.close()
+        pool.join()
+    # NOTE: only the disks and the cloud-init seed images of the domains are
+    # removed, the backing images and the seed cache are kept.
+    if paths:
+        hypervisor.call('rm', '-f', *sorted(set(paths)))
+    logging.info("Purged %d domain(s) of the %s prefix in %.1fs" % (
+        len(domains), prefix, time.time() - start))
+
+
+def estimate_footprint(hosts, hostnames):
+    """Compute the resources needed by the hosts.
+
+    The memory is in KiB and the disks in bytes. The disks are counted at
+    their full size, the backing images are returned apart since they are
+    shared by all the hosts, with the size of the biggest disk built on
+    each of them.
+    """
+    footprint = {'memory': 0, 'vcpus': 0, 'disk': 0, 'images': {}}
+    for hostname in hostnames:
+        host = hosts[hostname]
+        footprint['memory'] += host.get('memory', _DEFAULT_MEMORY)
+        footprint['vcpus'] += host.get('ncpus', _DEFAULT_NCPUS)
+        for disk in host.get('disks', []):
+            size = size_in_bytes(disk['size'])
+            footprint['disk'] += size
+            if 'image' in disk:
+                footprint['images'][disk['image']] = max(
+                    size, footprint['images'].get(disk['image'], 0))
+    return footprint
+
+
+def check_capacity(hypervisor, hosts, hostnames):
+    """Compare the footprint of the hosts with the hypervisor resources.
+
+    Log the plan and return False if the hosts cannot fit. The disks are
+    thin provisioned, so only the download of the missing images has to fit
+    right now, the full size of the disks only produces a warning. The
+    images of unknown size are not counted.
+    """
+    footprint = estimate_footprint(hosts, hostnames)
+    try:
+        free = hypervisor.free_resources(sorted(footprint['images']))
+    except ValueError as e:
+        logging.warn("Cannot check the capacity of %s: %s" % (
+            hypervisor.target_host, e))
+        return True
+    downloads = sum(hypervisor.download_sizes(sorted(
+        image for image in footprint['images']
+        if image not in free['images'])).values())
+    rows = [('memory (KiB)', footprint['memory'], free['memory'], True),
+            ('vCPU', footprint['vcpus'], free['vcpus'], True),
+            ('images (B)', downloads, free['disk'], True),
+            ('disks (B)', downloads + footprint['disk'], free['disk'], False)]
+    logging.info("Capacity of %s for %d host(s):" % (
+        hypervisor.target_host, len(hostnames)))
+    fits = True
+    for name, needed, available, mandatory in rows:
+        status = 'ok'
+        if needed > available:
+            status = 'NOT ENOUGH' if mandatory else 'overcommitted'
+            fits = fits and not mandatory
+        logging.info("  %-12s %16d needed %16d free  %s" % (
+            name, needed, available, status))
+    return fits
+
+
+def place_hosts(hypervisors, hosts, hostnames):
+    """Pick the hypervisor of each host.
+
+    The biggest hosts are placed first, each one on the hypervisor with the
+    least free memory that can hold it (best fit), this leaves the other
+    hypervisors free for the other environments.
+    """
+    if len(hypervisors) == 1:
+        return dict((hostname, hypervisors[0]) for hostname in hostnames)
+
+    free = [hypervisor.free_resources() for hypervisor in hypervisors]
+
+    def footprint(hostname):
+        return (hosts[hostname].get('memory', _DEFAULT_MEMORY),
+                hosts[hostname].get('ncpus', _DEFAULT_NCPUS))
+
+    placement = {}
+    for hostname in sorted(hostnames, key=lambda h: (footprint(h), h),
+                           reverse=True):
+        memory, ncpus = footprint(hostname)
+        candidates = [i for i in range(len(hypervisors))
+                      if free[i]['memory'] >= memory and
+                      free[i]['vcpus'] >= ncpus]
+        if not candidates:
+            raise Hypervisor.NotEnoughResources(
+                "No hypervisor can hold %s (%d KiB, %d vCPU)" % (
+                    hostname, memory, ncpus))
+        i = min(candidates, key=lambda i: (free[i]['memory'], i))
+        free[i]['memory'] -= memory
+        free[i]['vcpus'] -= ncpus
+        placement[hostname] = hypervisors[i]
+        logging.info("Host '%s' placed on %s" % (hostname,
+                                                 hypervisors[i].target_host))
+    return placement
+
+
+def group_by_images(hosts, hostnames):
+    """Group the hosts that use the same images."""
+    groups = {}
+    for hostname in hostnames:
+        images = tuple(sorted(set(disk['image']
+                                  for disk in hosts[hostname]['disks']
+                                  if 'image' in disk)))
+        groups.setdefault(images, []).append(hostname)
+    return [groups[key] for key in sorted(groups)]
+
+
+def prepare_hosts(hypervisor, conf, hosts, hostnames, downloads):
+    """Prepare the disks and the cloud-init images of a group of hosts.
+
+    Wait for the images of the hosts, then prepare all the hosts in a single
+    round trip to the hypervisor. Return the Host instances, or None if
+    something failed.
+    """
+    with _TRACER.span('wait_images', ', '.join(hostnames)):
+        for hostname in hostnames:
+            for disk in hosts[hostname]['disks']:
+                if disk.get('image') in downloads and \
+                        not downloads[disk['image']].get():
+                    logging.error("Cannot start %s, image '%s' is missing" %
+                                  (hostname, disk['image']))
+                    return None
+
+    plan = RemotePlan()
+    instances = []
+    for hostname in hostnames:
+        host_description = hosts[hostname]
+        host_description['hostname'] = hostname
+        instances.append(Host(hypervisor, conf, host_description, plan=plan))
+    with _TRACER.span('storage', ', '.join(hostnames),
+                      host=hypervisor.target_host):
+        failures = plan.failures(hypervisor.execute(plan))
+    for step in failures:
+        logging.error("Failed to run '%s'" % step)
+    return None if failures else instances
 
 
-def main(argv=sys.argv[1:]):
-    conf = get_conf(argv)
-    infra_description = load_infra_description(conf.input_file)
-    hypervisor = Hypervisor(conf, infra_description)
+def get_start_waves(hosts, start_first):
+    """Split the hosts in groups to start one after the other.
 
-    if conf.cleanup:
-        purge_existing_domains(hypervisor, conf.prefix)
-    hypervisor.configure_networks()
+    The hosts of each profile listed in start_first get their own group, in
+    the given order, the remaining hosts are started in a last group.
+    """
+    waves = [[] for _ in range(len(start_first) + 1)]
+    for hostname in sorted(hosts):
+        profile = hosts[hostname].get('profile')
+        if profile in start_first:
+            waves[start_first.index(profile)].append(hostname)
+        else:
+            waves[-1].append(hostname)
+    return [wave for wave in waves if wave]
 
-    hypervisor.download_images()
 
-    hosts = infra_description['hosts']
+def stable_values(name):
+    """Return an UUID, a MAC address and a bridge name derived from name."""
+    value = uuid.uuid5(uuid.NAMESPACE_URL, name)
+    return {'uuid': str(value),
+            'mac': '52:54:00:%s:%s:%s' % (value.hex[0:2], value.hex[2:4],
+                                          value.hex[4:6]),
+            'bridge_name': 'virbr%d' % (value.int & 0xffffffff)}
 
+
+def render(conf, infra_description, directory):
+    """Write the libvirt XML and the cloud-init data of the environment.
+
+    The random values (UUID, network MAC address and bridge name) are
+    derived from the names, so two renderings can be compared.
+    """
+    hypervisor = RenderOnlyHypervisor(conf, infra_description)
+    hosts = infra_description['hosts']
+    files = {}
+    reservations = {}
+    if conf.static_leases:
+        reservations = hypervisor.reservations(get_public_macs(conf, hosts))
+    public_net, _ = hypervisor.new_public_network(
+        reservations, stable_values(conf.public_network))
+    private_net_name = "%s_sps" % conf.prefix
+    private_net = Network(private_net_name, dict(
+        stable_values(private_net_name), mtu=_PRIVATE_NET_MTU))
+    for name, network in ((conf.public_network, public_net),
+                          (private_net_name, private_net)):
+        files['networks/%s.xml' % name] = network.dump_libvirt_xml()
     for hostname in sorted(hosts):
-        host_description = hosts[hostname]
-        host_description['hostname'] = hostname
-        host = Host(hypervisor, conf, host_description)
-        host.start()
+        hosts[hostname]['hostname'] = hostname
+        definition = dict(hosts[hostname])
+        definition.setdefault('uuid', stable_values(
+            "%s_%s" % (conf.prefix, hostname))['uuid'])
+        host = Host(hypervisor, conf, definition, plan=RemotePlan())
+        files['domains/%s.xml' % host.hostname_with_prefix] = (
+            host.dump_libvirt_xml())
+        for name, content in six.iteritems(host.cloud_init):
+            files['cloud-init/%s/%s' % (hostname, name)] = content
+
+    for path, content in sorted(six.iteritems(files)):
+        path = os.path.join(directory, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with io.open(path, 'w', encoding='utf-8') as fd:
+            fd.write(six.text_type(content))
+    logging.info("%d files written in %s" % (len(files), directory))
 
-    for hostname, host_description in \
-            six.iteritems(infra_description['hosts']):
-        for n in host_description['nics']:
-            try:
-                if n['network_name'] != conf.public_network:
-                    continue
-                if n['bootproto'] != 'dhcp':
-                    continue
-            except KeyError:
-                continue
 
-            logging.info("Waiting for '%s' DHCP query with MAC '%s'" % (
-                hostname, n['mac']))
+def main(argv=sys.argv[1:]):
+    conf = get_conf(argv)
+    infra_description = load_infra_description(
+        conf.input_file, stable_macs=bool(conf.render_only))
+    if conf.render_only:
+        render(conf, infra_description, conf.render_only)
+        return
+    hypervisors = []
+    _TRACER.reset()
+    try:
+        with _TRACER.span('deploy'):
+            for target_host in conf.target_host.split(','):
+                with _TRACER.span('connect', target_host):
+                    hypervisors.append(Hypervisor(conf, infra_description,
+                                                  target_host))
+            deploy(conf, infra_description, hypervisors)
+    finally:
+        for hypervisor in hypervisors:
+            hypervisor.close()
+        for line in _TRACER.summary():
+            logging.info(line)
+        if conf.trace:
+            _TRACER.write(conf.trace)
+            logging.info("Trace written in %s" % conf.trace)
+
+
+def deploy(conf, infra_description, hypervisors):
+    hosts = infra_description['hosts']
+    to_create = set(hosts)
+    placement = {}
+    to_start = []
+    for hypervisor in hypervisors:
+        if conf.check_only:
+            break
+        if conf.cleanup:
+            with _TRACER.span('cleanup', hypervisor.target_host):
+                purge_existing_domains(hypervisor, conf.prefix,
+                                       conf.parallel)
+                hypervisor.remove_private_tunnel()
+        if conf.reconcile:
+            with _TRACER.span('reconcile', hypervisor.target_host):
+                missing, kept = reconcile_domains(hypervisor, conf, hosts)
+            to_start += kept
+            for hostname in set(hosts) - set(missing):
+                placement[hostname] = hypervisor
+            to_create &= set(missing)
+    try:
+        with _TRACER.span('placement'):
+            placement.update(place_hosts(hypervisors, hosts, to_create))
+    except Hypervisor.NotEnoughResources as e:
+        logging.error(e)
+        sys.exit(1)
+    fits = True
+    for hypervisor in hypervisors:
+        with _TRACER.span('preflight', hypervisor.target_host):
+            fits &= check_capacity(hypervisor, hosts, [
+                h for h in sorted(to_create) if placement[h] is hypervisor])
+    if not fits:
+        logging.error("Not enough resources for the environment")
+        sys.exit(1)
+    if conf.check_only:
+        return
+
+    public_macs = {}
+    for hypervisor in hypervisors:
+        hostnames = [h for h in hosts if placement[h] is hypervisor]
+        public_macs[hypervisor] = get_public_macs(
+            conf, dict((h, hosts[h]) for h in hostnames))
+        with _TRACER.span('networks', hypervisor.target_host):
+            public_ips = hypervisor.configure_networks(
+                public_macs[hypervisor] if conf.static_leases else None)
+        for mac, ip in sorted(six.iteritems(public_ips)):
             logging.info("Host '%s' has public IP: '%s'" % (
-                hostname, hypervisor.wait_for_lease(n['mac'])))
+                public_macs[hypervisor][mac], ip))
+    if len(hypervisors) > 1:
+        for hypervisor in hypervisors:
+            with _TRACER.span('networks', 'tunnel %s' %
+                              hypervisor.target_host):
+                if not hypervisor.connect_private_net(
+                        [peer for peer in hypervisors
+                         if peer is not hypervisor]):
+                    sys.exit(1)
+    for dom in to_start:
+        logging.info("Starting the kept domain %s" % dom.name())
+        dom.create()
+
+    # NOTE: the hosts are started as soon as their own images are ready, the
+    # download of the other images goes on in the background.
+    download_pool = ThreadPool(conf.parallel_downloads)
+    pool = ThreadPool(conf.parallel)
+    failed = False
+    try:
+        downloads = dict(
+            (hypervisor, hypervisor.start_downloads(
+                download_pool,
+                [h for h in to_create if placement[h] is hypervisor]))
+            for hypervisor in hypervisors)
+        for wave in get_start_waves(dict((h, hosts[h]) for h in to_create),
+                                    conf.start_first):
+            groups = []
+            for hypervisor in hypervisors:
+                groups += [(hypervisor, group) for group in group_by_images(
+                    hosts, [h for h in wave if placement[h] is hypervisor])]
+            prepare_pool = ThreadPool(len(groups))
+            try:
+                starts = []
+                for instances in prepare_pool.imap_unordered(
+                        lambda group: prepare_hosts(group[0], conf, hosts,
+                                                    group[1],
+                                                    downloads[group[0]]),
+                        groups):
+                    if instances is None:
+                        failed = True
+                        continue
+                    starts += [pool.apply_async(host.start)
+                               for host in instances]
+                for start in starts:
+                    start.get()
+            except BaseException:
+                prepare_pool.terminate()
+                raise
+            prepare_pool.close()
+            prepare_pool.join()
+    except BaseException:
+        # NOTE: do not wait for the queued downloads and starts, e.g: on
+        # Ctrl-C or when a host fails to start.
+        for p in (download_pool, pool):
+            p.terminate()
+        raise
+    for p in (download_pool, pool):
+        p.close()
+        p.join()
+    for hypervisor in hypervisors:
+        with _TRACER.span('mtu', hypervisor.target_host):
+            hypervisor.verify_mtu()
+    if failed:
+        sys.exit(1)
+
+    if not conf.static_leases:
+        for hypervisor in hypervisors:
+            with _TRACER.span('leases', hypervisor.target_host):
+                wait_for_public_ips(conf, hypervisor,
+                                    public_macs[hypervisor])
+
+
+def wait_for_public_ips(conf, hypervisor, public_macs):
+    for mac, name in sorted(six.iteritems(public_macs)):
+        logging.info("Waiting for '%s' DHCP query with MAC '%s'" % (name, mac))
+    leases = hypervisor.wait_for_leases(public_macs, conf.lease_timeout)
+    for mac, name in sorted(six.iteritems(public_macs)):
+        if mac in leases:
+            logging.info("Host '%s' has public IP: '%s'" % (
+                name, leases[mac]))
+        else:
+            logging.error("Host '%s' got no DHCP lease for MAC '%s'" % (
+                name, mac))
+    if len(leases) != len(public_macs):
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import argparse
+import copy
+import json
+import logging
+import re
+import sys
+import threading
+import time
+
+import six
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+
+import virtualizor
+
+# NOTE: the finished jobs are forgotten after a while
+_MAX_FINISHED_JOBS = 100
+
+
+class Job(object):
+    """A deploy or a teardown request."""
+
+    def __init__(self, job_id, action, conf, infra_description=None):
+        self.id = job_id
+        self.action = action
+        self.conf = conf
+        self.infra_description = infra_description
+        self.state = 'queued'
+        self.exit_code = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def to_dict(self):
+        return {'id': self.id,
+                'action': self.action,
+                'prefix': self.conf.prefix,
+                'target_hosts': self.conf.target_host.split(','),
+                'state': self.state,
+                'exit_code': self.exit_code,
+                'error': self.error,
+                'created': self.created,
+                'started': self.started,
+                'finished': self.finished}
+
+
+class Daemon(object):
+    """Run the deployments with warm connections to the hypervisors.
+
+    One Hypervisor is kept per server, each job works on a clone of it so
+    the libvirt connection, the emulator and the SSH master connection are
+    shared. At most max_jobs jobs run at the same time on a hypervisor, and
+    a prefix is never handled by two jobs at the same time.
+    """
+
+    def __init__(self, max_jobs=2):
+        self._max_jobs = max_jobs
+        self._lock = threading.Lock()
+        self._hypervisors = {}
+        # NOTE: the number of jobs using each Hypervisor, a replaced one is
+        # closed when its last job is done.
+        self._users = {}
+        self._stale = set()
+        self._slots = {}
+        self._prefix_locks = {}
+        self._jobs = {}
+        self._next_id = 1
+
+    def hypervisor(self, target_host, conf, acquire=False):
+        """Return the Hypervisor of a server.
+
+        With acquire, the Hypervisor is kept open until it is released, even
+        if it is replaced in the meantime.
+        """
+        with self._lock:
+            if target_host not in self._hypervisors:
+                self._slots[target_host] = threading.Semaphore(
+                    self._max_jobs)
+                self._hypervisors[target_host] = None
+        # NOTE: the first job of a server opens the connection, a job
+        # opens it again when it was lost.
+        with self._prefix_lock(None, target_host):
+            hypervisor = self._hypervisors[target_host]
+            if hypervisor is not None and not is_alive(hypervisor):
+                logging.warning("Lost the connection to %s, reconnecting" %
+                                target_host)
+                with self._lock:
+                    self._stale.add(hypervisor)
+                self.release(hypervisor, 0)
+                hypervisor = None
+            if hypervisor is None:
+                hypervisor = virtualizor.Hypervisor(conf, {}, target_host)
+                self._hypervisors[target_host] = hypervisor
+            if acquire:
+                with self._lock:
+                    self._users[hypervisor] = self._users.get(
+                        hypervisor, 0) + 1
+        return hypervisor
+
+    def release(self, hypervisor, count=1):
+        """Release an acquired Hypervisor, close it if it was replaced."""
+        with self._lock:
+            users = self._users.get(hypervisor, 0) - count
+            self._users[hypervisor] = users
+            if users > 0 or hypervisor not in self._stale:
+                return
+            self._stale.discard(hypervisor)
+            del self._users[hypervisor]
+        hypervisor.close()
+
+    def _prefix_lock(self, prefix, target_host):
+        with self._lock:
+            return self._prefix_locks.setdefault((prefix, target_host),
+                                                 threading.Lock())
+
+    def submit(self, action, conf, infra_description=None):
+        with self._lock:
+            job = Job(self._next_id, action, conf, infra_description)
+            self._next_id += 1
+            self._jobs[job.id] = job
+            finished = sorted(j.id for j in self._jobs.values()
+                              if j.finished is not None)
+            for job_id in finished[:-_MAX_FINISHED_JOBS]:
+                del self._jobs[job_id]
+        thread = threading.Thread(target=self._run, args=(job,))
+        thread.daemon = True
+        thread.start()
+        return job
+
+    def job(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def status(self):
+        with self._lock:
+            jobs = [job.to_dict() for _, job in sorted(
+                six.iteritems(self._jobs))]
+            hypervisors = sorted(self._hypervisors)
+        return {'hypervisors': dict(
+                    (target_host, {
+                        'running': len([j for j in jobs
+                                        if j['state'] == 'running' and
+                                        target_host in j['target_hosts']]),
+                        'queued': len([j for j in jobs
+                                       if j['state'] == 'queued' and
+                                       target_host in j['target_hosts']])})
+                    for target_host in hypervisors),
+                'jobs': jobs}
+
+    def _run(self, job):
+        target_hosts = sorted(job.conf.target_host.split(','))
+        locks = []
+        acquired = []
+        try:
+            for target_host in target_hosts:
+                self.hypervisor(target_host, job.conf)
+            # NOTE: always in the same order to avoid deadlocks, and a job
+            # waiting for its prefix does not hold a slot.
+            for lock in ([self._prefix_lock(job.conf.prefix, target_host)
+                          for target_host in target_hosts] +
+                         [self._slots[target_host]
+                          for target_host in target_hosts]):
+                lock.acquire()
+                locks.append(lock)
+            job.state = 'running'
+            job.started = time.time()
+            for target_host in job.conf.target_host.split(','):
+                acquired.append(self.hypervisor(target_host, job.conf,
+                                                acquire=True))
+            hypervisors = [hypervisor.clone(job.conf,
+                                            job.infra_description or {})
+                           for hypervisor in acquired]
+            if job.action == 'deploy':
+                virtualizor.deploy(job.conf, job.infra_description,
+                                   hypervisors)
+            else:
+                for hypervisor in hypervisors:
+                    teardown(hypervisor, job.conf)
+            job.exit_code = 0
+        except SystemExit as e:
+            job.exit_code = e.code if e.code is not None else 0
+        except Exception as e:
+            logging.exception("Job %d failed" % job.id)
+            job.exit_code = 1
+            job.error = str(e)
+        finally:
+            for hypervisor in acquired:
+                self.release(hypervisor)
+            for lock in reversed(locks):
+                lock.release()
+            job.state = 'done' if job.exit_code == 0 else 'failed'
+            job.finished = time.time()
+
+    def close(self):
+        with self._lock:
+            hypervisors = [h for h in self._hypervisors.values() if h]
+            hypervisors += list(self._stale)
+        for hypervisor in hypervisors:
+            hypervisor.close()
+
+
+def is_alive(hypervisor):
+    """Tell whether the libvirt connection of a hypervisor still works."""
+    try:
+        return bool(hypervisor.conn.isAlive())
+    except virtualizor.libvirt.libvirtError:
+        return False
+
+
+def teardown(hypervisor, conf):
+    """Remove the domains and the private network of a prefix."""
+    virtualizor.purge_existing_domains(hypervisor, conf.prefix,
+                                       conf.parallel)
+    hypervisor.remove_private_tunnel()
+    private_net_name = "%s_sps" % conf.prefix
+    if private_net_name in [n.name() for n in
+                            hypervisor.conn.listAllNetworks()]:
+        hypervisor.conn.networkLookupByName(private_net_name).destroy()
+
+
+class BadRequest(Exception):
+    pass
+
+
+def parse_request(body):
+    """Return the virtualizor configuration of a deploy or a teardown.
+
+    The request is a JSON object with the command line arguments of
+    virtualizor.py in 'argv'. The infra description can be given inline
+    in 'infra_description', then the input file is not read.
+    """
+    try:
+        request = json.loads(body.decode('utf-8'))
+        argv = [str(arg) for arg in request['argv']]
+    except (ValueError, KeyError, TypeError) as e:
+        raise BadRequest("Invalid request: %s" % e)
+    try:
+        conf = virtualizor.get_conf(argv)
+    except SystemExit:
+        raise BadRequest("Invalid arguments: %s" % ' '.join(argv))
+    if conf.target_host is None:
+        raise BadRequest("The target_host argument is required")
+    return conf, request.get('infra_description')
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def _reply(self, code, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        m = re.match(r'^/jobs/(\d+)$', self.path)
+        if self.path == '/status':
+            self._reply(200, self.server.daemon.status())
+        elif m and self.server.daemon.job(int(m.group(1))):
+            self._reply(200, self.server.daemon.job(
+                int(m.group(1))).to_dict())
+        else:
+            self._reply(404, {'error': 'Not found: %s' % self.path})
+
+    def do_POST(self):
+        if self.path not in ('/deploy', '/teardown'):
+            self._reply(404, {'error': 'Not found: %s' % self.path})
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            conf, infra_description = parse_request(body)
+            if self.path == '/deploy':
+                # NOTE: the description is completed by each job, the MAC
+                # addresses and the fingerprints are added in place.
+                if infra_description is None:
+                    infra_description = virtualizor.load_infra_description(
+                        conf.input_file)
+                else:
+                    infra_description = virtualizor.prepare_infra_description(
+                        copy.deepcopy(infra_description))
+        except BadRequest as e:
+            self._reply(400, {'error': str(e)})
+            return
+        except (IOError, ValueError) as e:
+            self._reply(400, {'error': 'Invalid infra description: %s' % e})
+            return
+        job = self.server.daemon.submit(self.path[1:], conf,
+                                        infra_description)
+        self._reply(202, job.to_dict())
+
+    def log_message(self, format, *args):
+        logging.info("%s %s" % (self.address_string(), format % args))
+
+
+class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, daemon):
+        BaseHTTPServer.HTTPServer.__init__(self, address, RequestHandler)
+        self.daemon = daemon
+
+
+def get_conf(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description='Serve the virtualizor deployments over HTTP.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--listen', default='127.0.0.1:8470',
+                        help='the address and the port to listen on.')
+    parser.add_argument('--max-jobs', default=2, type=int,
+                        help='the number of jobs that can run at the same '
+                        'time on a hypervisor, the other ones are queued.')
+    return parser.parse_args(argv)
+
+
+def main(argv=sys.argv[1:]):
+    conf = get_conf(argv)
+    address, port = conf.listen.rsplit(':', 1)
+    # NOTE: the phases of the concurrent jobs would be mixed
+    virtualizor._TRACER.enabled = False
+    daemon = Daemon(conf.max_jobs)
+    server = Server((address, int(port)), daemon)
+    logging.info("Listening on %s" % conf.listen)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.close()
+
+
+if __name__ == '__main__':
+    main()